@@ -6,26 +6,96 @@ from flask_login import LoginManager
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
-
 class Base(DeclarativeBase):
     pass
 
 db = SQLAlchemy(model_class=Base)
 
+def _engine_options(database_url):
+    """Connection pool settings for the configured database backend
+
+    SQLite only needs a busy timeout here; its pragmas are applied per
+    connection by _set_sqlite_pragmas. Server databases get a sized pool that
+    is recycled periodically. Pre-ping is off by default: SQLAlchemy detects
+    dropped connections when a statement fails and invalidates the pool, so
+    only the request that hit the dead connection fails instead of every
+    checkout paying a round trip.
+    """
+    if database_url.startswith("sqlite"):
+        return {"connect_args": {"timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000)) / 1000}}
+    
+    options = {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 20)),
+        "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes"),
+        "pool_use_lifo": True,  # Let surplus connections idle out instead of cycling through all of them
+    }
+    if database_url.startswith("postgresql"):
+        statement_timeout = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 15000))
+        options["connect_args"] = {"options": f"-c statement_timeout={statement_timeout}"}
+    return options
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers run alongside the writer; NORMAL sync is durable across app crashes in WAL mode"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')}")
+    cursor.execute(f"PRAGMA busy_timeout={int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))}")
+    cursor.close()
+
 def create_app():
     # Create the app
     app = Flask(__name__)
+    
+    # Configure logging; LOG_LEVEL takes standard level names (DEBUG, INFO, WARNING, ...)
+    app.config["LOG_LEVEL"] = os.environ.get("LOG_LEVEL", "INFO").upper()
+    logging.basicConfig(level=app.config["LOG_LEVEL"])
+    logging.getLogger().setLevel(app.config["LOG_LEVEL"])
+    
     app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
     app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
     # Configure the database
     app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///secure_messaging.db")
-    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-        "pool_recycle": 300,
-        "pool_pre_ping": True,
-    }
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = _engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
+    
+    # Master keyring file; relative paths resolve against the app directory, not the CWD
+    app.config["MASTER_KEY_FILE"] = os.environ.get("MASTER_KEY_FILE", "master.key")
+    app.config["SCHEMA_AUTO_CREATE"] = os.environ.get("SCHEMA_AUTO_CREATE", "false").lower() in ("1", "true", "yes")
+    
+    # Server-Sent Events stream settings; streams hold a worker for up to
+    # STREAM_MAX_DURATION, so chat pages only open them with STREAM_ENABLED
+    # (set by asgi.py, or enable it for threaded/gevent workers)
+    app.config["STREAM_ENABLED"] = os.environ.get("STREAM_ENABLED", "false").lower() in ("1", "true", "yes")
+    app.config["STREAM_KEEPALIVE_SECONDS"] = int(os.environ.get("STREAM_KEEPALIVE_SECONDS", 15))
+    app.config["STREAM_MAX_DURATION"] = int(os.environ.get("STREAM_MAX_DURATION", 300))
+    
+    # Message ingestion: "direct" commits each message, "batched" group-commits
+    # queued messages; the ack policy is "committed" or "queued" (see ingest.py)
+    app.config["MESSAGE_INGEST_MODE"] = os.environ.get("MESSAGE_INGEST_MODE", "direct")
+    app.config["MESSAGE_INGEST_ACK"] = os.environ.get("MESSAGE_INGEST_ACK", "committed")
+    app.config["MESSAGE_INGEST_BATCH_SIZE"] = int(os.environ.get("MESSAGE_INGEST_BATCH_SIZE", 100))
+    app.config["MESSAGE_INGEST_MAX_DELAY_MS"] = int(os.environ.get("MESSAGE_INGEST_MAX_DELAY_MS", 20))
+    app.config["MESSAGE_INGEST_ACK_TIMEOUT"] = int(os.environ.get("MESSAGE_INGEST_ACK_TIMEOUT", 5))
+    
+    # Presence: users count as online for PRESENCE_TTL seconds after their last
+    # request; User.is_online and last_seen are written in batches every
+    # PRESENCE_FLUSH_INTERVAL, and is_online clears once last_seen is PRESENCE_TTL old
+    app.config["PRESENCE_TTL"] = int(os.environ.get("PRESENCE_TTL", 60))
+    app.config["PRESENCE_FLUSH_INTERVAL"] = int(os.environ.get("PRESENCE_FLUSH_INTERVAL", 30))
+    
+    # Retention: per-room policies are enforced every RETENTION_INTERVAL seconds
+    # (0 disables the background job) in batches of RETENTION_BATCH_SIZE rows
+    app.config["RETENTION_INTERVAL"] = int(os.environ.get("RETENTION_INTERVAL", 3600))
+    app.config["RETENTION_BATCH_SIZE"] = int(os.environ.get("RETENTION_BATCH_SIZE", 1000))
+    app.config["RETENTION_BATCH_PAUSE"] = float(os.environ.get("RETENTION_BATCH_PAUSE", 0))
+    
+    # Instrumentation: request, SQL, crypto and render timings on /metrics, off by
+    # default; METRICS_TOKEN makes the endpoint require a bearer token
+    app.config["METRICS_ENABLED"] = os.environ.get("METRICS_ENABLED", "false").lower() in ("1", "true", "yes")
+    app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
     
     # Initialize extensions
     db.init_app(app)
@@ -43,14 +113,41 @@ def create_app():
         return User.query.get(int(user_id))
 
     with app.app_context():
-        # Import models to ensure tables are created
-        from models import User, Message, Room
-        db.create_all()
+        if db.engine.dialect.name == "sqlite":
+            db.event.listen(db.engine, "connect", _set_sqlite_pragmas)
+        
+        # Schema changes are applied explicitly with `flask --app main schema upgrade`;
+        # SCHEMA_AUTO_CREATE restores create-on-boot for throwaway databases
+        if app.config["SCHEMA_AUTO_CREATE"]:
+            import models
+            db.create_all()
+        
+        # Keys are read on first use from the configured keyring file
+        from crypto_utils import crypto_manager
+        crypto_manager.init_app(app)
         
         # Register blueprints
         from routes import main
         app.register_blueprint(main)
+        
+        # Wire batched ingestion to the post-commit announcements
+        from ingest import message_ingestor
+        from routes import announce_messages, record_inserted
+        from queries import assign_room_seqs
+        message_ingestor.init_app(app, on_commit=announce_messages, before_insert=assign_room_seqs,
+                                  on_insert=record_inserted)
+        
+        from presence import presence_tracker
+        presence_tracker.init_app(app)
+        
+        from retention import retention_engine
+        retention_engine.init_app(app)
+        
+        from metrics import metrics
+        metrics.init_app(app)
+        
+        # Register CLI commands
+        from commands import register_commands
+        register_commands(app)
 
     return app
-
-app = create_app()
@@ -0,0 +1,225 @@
+"""ASGI entry point for serving many long-lived connections from one process
+
+Run with any ASGI server, e.g. ``uvicorn asgi:application --port 5000``.
+
+Message streams (``/stream/<room_id>``) are handled here as coroutines: an
+idle connection is just a pending ``asyncio`` wait on the message hub, so it
+costs no thread or DB connection. Authentication, the replay query and
+decryption run on a thread pool. Every other request is passed to the Flask
+app through a small WSGI bridge on the same pool.
+"""
+import asyncio
+import io
+import os
+import re
+import sys
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from flask import request
+from flask_login import current_user
+
+# Idle streams are cheap here, so chat pages may open them
+os.environ.setdefault("STREAM_ENABLED", "true")
+
+from main import app
+from realtime import message_hub
+from presence import presence_tracker
+from membership import membership_cache
+import queries
+import routes
+
+logger = logging.getLogger(__name__)
+
+STREAM_PATH = re.compile(r"^/stream/(\d+)$")
+
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get("ASGI_THREADS", 32)), thread_name_prefix='asgi')
+
+def _build_environ(scope, body):
+    """Translate an ASGI HTTP scope into a WSGI environ"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        if name == 'CONTENT_TYPE':
+            environ[name] = value
+            continue
+        key = f'HTTP_{name}'
+        if key in environ:
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+    # The body is fully buffered, so its length is known even for chunked uploads
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+def _call_wsgi(environ):
+    """Run the Flask app for one request and collect the full response"""
+    captured = {}
+
+    def start_response(status, headers, exc_info=None):
+        captured['status'] = int(status.split(' ', 1)[0])
+        captured['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        return lambda data: captured.setdefault('written', []).append(data)
+
+    result = app(environ, start_response)
+    try:
+        body = b''.join(captured.get('written', [])) + b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return captured['status'], captured['headers'], body
+
+async def _handle_wsgi(scope, receive, send):
+    body = await _read_body(receive)
+    if body is None:
+        return
+    loop = asyncio.get_running_loop()
+    status, headers, content = await loop.run_in_executor(executor, _call_wsgi, _build_environ(scope, body))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': content})
+
+def _open_stream(environ, room_id):
+    """Authenticate a stream request and build its replay frames (runs on the pool)"""
+    with app.request_context(environ):
+        if not current_user.is_authenticated:
+            return 401, None
+        if not membership_cache.is_member(room_id, current_user.id):
+            return 403, None
+
+        since = request.headers.get('Last-Event-ID', type=int)
+        if since is None:
+            since = request.args.get('since', type=int)
+
+        frames = []
+        last_id = since or 0
+        if since is not None:
+            for event in routes._replay_events(room_id, since):
+                last_id = event['id']
+                frames.append(routes._format_sse(event, current_user.id))
+
+        presence_tracker.heartbeat(current_user.id, current_user.username, room_id)
+        return 200, (current_user.id, current_user.username, last_id, frames)
+
+def _catch_up(environ, room_id, last_id):
+    """Replay messages newer than last_id that reached the room through another worker (runs on the pool)"""
+    with app.request_context(environ):
+        frames = []
+        if queries.get_latest_message_id(room_id) > last_id:
+            for event in routes._replay_events(room_id, last_id):
+                last_id = event['id']
+                frames.append(routes._format_sse(event, current_user.id))
+        return last_id, frames
+
+async def _handle_stream(scope, receive, send, room_id):
+    """Coroutine version of routes.stream_messages"""
+    keepalive = app.config['STREAM_KEEPALIVE_SECONDS']
+    max_duration = app.config['STREAM_MAX_DURATION']
+    loop = asyncio.get_running_loop()
+    environ = _build_environ(scope, b'')
+
+    # Subscribe before the replay query so nothing slips in between
+    subscriber = message_hub.subscribe_async(room_id)
+    try:
+        status, opened = await loop.run_in_executor(executor, _open_stream, environ, room_id)
+        if status != 200:
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': [(b'content-type', b'application/json')]})
+            await send({'type': 'http.response.body', 'body': b'{"error": "Access denied"}'})
+            return
+        user_id, username, last_id, frames = opened
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        for frame in [f"retry: {keepalive * 1000}\n\n"] + frames:
+            await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        deadline = time.monotonic() + max_duration
+        try:
+            while time.monotonic() < deadline:
+                next_event = asyncio.ensure_future(subscriber.get())
+                done, _ = await asyncio.wait({next_event, disconnected}, timeout=keepalive,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    next_event.cancel()
+                    return
+                if next_event not in done:
+                    next_event.cancel()
+                    # An open stream keeps its user present in the room
+                    presence_tracker.heartbeat(user_id, username, room_id)
+                    # The hub is per process; pick up messages sent through other workers
+                    last_id, frames = await loop.run_in_executor(executor, _catch_up, environ, room_id, last_id)
+                    frame = ''.join(frames) + ": keepalive\n\n"
+                else:
+                    event = next_event.result()
+                    if event['id'] <= last_id:
+                        continue
+                    last_id = event['id']
+                    frame = routes._format_sse(event, user_id)
+                await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+    finally:
+        message_hub.unsubscribe(room_id, subscriber)
+
+async def _handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    """ASGI application callable"""
+    if scope['type'] == 'lifespan':
+        await _handle_lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    match = STREAM_PATH.match(scope['path'])
+    if match and scope['method'] == 'GET':
+        await _handle_stream(scope, receive, send, int(match.group(1)))
+    else:
+        await _handle_wsgi(scope, receive, send)
@@ -0,0 +1,46 @@
+"""Throughput benchmark for CryptoManager single-item vs batch decryption
+
+Usage: python benchmarks/bench_crypto.py [--sizes 1000 10000 100000] [--workers 4]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crypto_utils import CryptoManager
+
+
+def _time(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def run(sizes, workers, message_length):
+    manager = CryptoManager()
+    plaintext = 'x' * message_length
+
+    print(f"{'messages':>10} {'loop msg/s':>12} {'batch msg/s':>12} {'pool msg/s':>12}")
+    for size in sizes:
+        ciphertexts = [result.value for result in manager.encrypt_many([plaintext] * size)]
+
+        loop = _time(lambda: [manager.decrypt_message(token) for token in ciphertexts])
+        batch = _time(lambda: manager.decrypt_many(ciphertexts))
+        pool = _time(lambda: manager.decrypt_many(ciphertexts, max_workers=workers))
+
+        print(f"{size:>10} {size / loop:>12.0f} {size / batch:>12.0f} {size / pool:>12.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4)
+    parser.add_argument('--message-length', type=int, default=200)
+    args = parser.parse_args()
+    run(args.sizes, args.workers, args.message_length)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Messages-per-second benchmark for direct vs batched send_message ingestion
+
+Usage: python benchmarks/bench_ingest.py [--senders 8] [--messages 200]
+
+Runs against a throwaway SQLite database; each sender is a separate
+logged-in test client posting from its own thread.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _sender(app, username, messages, room_id, errors):
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': 'benchmark'})
+    for i in range(messages):
+        response = client.post('/send_message', data={'room_id': room_id, 'message': f'{username} message {i}'})
+        if response.status_code != 302:
+            errors.append(response.status_code)
+
+
+def run(senders, messages):
+    workdir = tempfile.mkdtemp(prefix='securechat-bench-')
+    os.chdir(workdir)
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+    from main import app
+    from app import db
+    from models import Message
+    from ingest import message_ingestor
+    logging.disable(logging.CRITICAL)
+    with app.app_context():
+        db.create_all()
+
+    usernames = [f'sender{n}' for n in range(senders)]
+    client = app.test_client()
+    for username in usernames:
+        client.post('/register', data={'username': username, 'email': f'{username}@bench.local',
+                                       'password': 'benchmark', 'confirm_password': 'benchmark'})
+
+    print(f"{'mode':>20} {'ack':>10} {'msg/s':>10}")
+    for mode, ack in (('direct', '-'), ('batched', 'committed'), ('batched', 'queued')):
+        app.config['MESSAGE_INGEST_MODE'] = mode
+        app.config['MESSAGE_INGEST_ACK'] = ack
+        with app.app_context():
+            before = db.session.query(db.func.count(Message.id)).scalar()
+
+        errors = []
+        threads = [threading.Thread(target=_sender, args=(app, username, messages, 1, errors)) for username in usernames]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        while message_ingestor.pending():
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+
+        with app.app_context():
+            stored = db.session.query(db.func.count(Message.id)).scalar() - before
+        rate = stored / elapsed
+        print(f"{mode:>20} {ack:>10} {rate:>10.0f}" + (f"  ({len(errors)} errors)" if errors else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--senders', type=int, default=8)
+    parser.add_argument('--messages', type=int, default=200)
+    args = parser.parse_args()
+    run(args.senders, args.messages)
+
+
+if __name__ == '__main__':
+    main()
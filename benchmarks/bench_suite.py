@@ -0,0 +1,220 @@
+"""Latency and throughput suite for the messaging hot paths
+
+Usage: python benchmarks/bench_suite.py [--users 50] [--rooms 10] [--messages 2000]
+                                        [--requests 200] [--output results.json]
+                                        [--baseline previous.json]
+
+Seeds a throwaway SQLite database with N users, rooms and messages, then
+measures CryptoManager encrypt/decrypt at several message sizes and the
+get_messages, chat and send_message views through the Flask test client.
+Reports p50/p95/p99 latency, SQL statements per request and operations per
+second. --output writes the results as JSON; --baseline compares against a
+previous run's JSON file.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'benchmark'
+
+
+def _summarize(samples, statements=None):
+    """Latency percentiles in milliseconds plus throughput for a list of durations"""
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    result = {
+        'count': len(samples),
+        'p50_ms': cuts[49] * 1000,
+        'p95_ms': cuts[94] * 1000,
+        'p99_ms': cuts[98] * 1000,
+        'ops_per_s': len(samples) / sum(samples),
+    }
+    if statements is not None:
+        result['sql_per_request'] = sum(statements) / len(statements)
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_crypto(manager, sizes, iterations):
+    results = {}
+    for size in sizes:
+        plaintext = 'x' * size
+        encrypt = []
+        tokens = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            tokens.append(manager.encrypt_message(plaintext))
+            encrypt.append(time.perf_counter() - start)
+
+        decrypt = []
+        for token in tokens:
+            start = time.perf_counter()
+            manager.decrypt_message(token)
+            decrypt.append(time.perf_counter() - start)
+
+        results[f'crypto.encrypt.{size}b'] = _summarize(encrypt)
+        results[f'crypto.decrypt.{size}b'] = _summarize(decrypt)
+    return results
+
+
+def seed(app, users, rooms, messages):
+    """Bulk-insert users, rooms, memberships and encrypted messages"""
+    from werkzeug.security import generate_password_hash
+    from app import db
+    from models import User, Room, RoomMember, Message
+    from crypto_utils import crypto_manager, room_key_id
+    from search import index_rows
+
+    password_hash = generate_password_hash(PASSWORD)
+    with app.app_context():
+        db.session.execute(db.insert(User), [
+            {'username': f'user{n}', 'email': f'user{n}@bench.local', 'password_hash': password_hash}
+            for n in range(users)
+        ])
+        db.session.execute(db.insert(Room), [
+            {'name': f'room{n}', 'description': 'Benchmark room', 'created_by_id': 1} for n in range(rooms)
+        ])
+        db.session.execute(db.insert(RoomMember), [
+            {'user_id': user_id, 'room_id': room_id}
+            for user_id in range(1, users + 1) for room_id in range(1, rooms + 1)
+        ])
+
+        per_room = max(1, messages // rooms)
+        for room_id in range(1, rooms + 1):
+            key_id = room_key_id(room_id, 1)
+            contents = [f'benchmark message {n} in room {room_id} with some ordinary words' for n in range(per_room)]
+            ciphertexts = [result.value for result in crypto_manager.encrypt_many(contents, key_ids=key_id)]
+            ids = db.session.scalars(
+                db.insert(Message).returning(Message.id, sort_by_parameter_order=True),
+                [{'content_encrypted': ciphertext, 'key_id': key_id, 'room_id': room_id,
+                  'sender_id': 1 + n % users} for n, ciphertext in enumerate(ciphertexts)]
+            ).all()
+            index_rows([{'id': message_id, 'room_id': room_id, 'content': content}
+                        for message_id, content in zip(ids, contents)])
+        db.session.commit()
+
+
+def bench_views(app, requests, room_id):
+    from app import db
+
+    statements = []
+    with app.app_context():
+        engine = db.engine
+
+    def count_statement(*args):
+        statements[-1] += 1
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'user0', 'password': PASSWORD})
+
+    cases = {
+        'view.get_messages': lambda n: client.get(f'/api/messages/{room_id}'),
+        'view.chat': lambda n: client.get(f'/chat/{room_id}'),
+        'view.send_message': lambda n: client.post('/send_message', data={'room_id': room_id, 'message': f'bench {n}'}),
+    }
+    expected = {'view.get_messages': 200, 'view.chat': 200, 'view.send_message': 302}
+
+    results = {}
+    db.event.listen(engine, 'before_cursor_execute', count_statement)
+    try:
+        for name, call in cases.items():
+            call(-1)  # Warm caches and connections
+            samples = []
+            statements.clear()
+            for n in range(requests):
+                statements.append(0)
+                start = time.perf_counter()
+                response = call(n)
+                samples.append(time.perf_counter() - start)
+                if response.status_code != expected[name]:
+                    raise RuntimeError(f"{name} returned {response.status_code}")
+            results[name] = _summarize(samples, statements)
+    finally:
+        db.event.remove(engine, 'before_cursor_execute', count_statement)
+    return results
+
+
+def _print(results, baseline):
+    print(f"{'case':<28} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>10} {'sql/req':>8}")
+    for name, result in results.items():
+        sql = f"{result['sql_per_request']:.1f}" if 'sql_per_request' in result else '-'
+        line = (f"{name:<28} {result['p50_ms']:>9.3f} {result['p95_ms']:>9.3f} {result['p99_ms']:>9.3f} "
+                f"{result['ops_per_s']:>10.0f} {sql:>8}")
+        previous = baseline.get(name)
+        if previous:
+            change = (result['p50_ms'] - previous['p50_ms']) / previous['p50_ms'] * 100
+            line += f"  p50 {change:+.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=2000, help='Total messages, spread across rooms.')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per view.')
+    parser.add_argument('--crypto-sizes', type=int, nargs='+', default=[64, 1024, 16384])
+    parser.add_argument('--crypto-iterations', type=int, default=2000)
+    parser.add_argument('--output', help='Write results as JSON to this file.')
+    parser.add_argument('--baseline', help='JSON results from an earlier run to compare against.')
+    args = parser.parse_args()
+
+    # Read the baseline and fix the output path before moving into the scratch directory
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    workdir = tempfile.mkdtemp(prefix='securechat-bench-')
+    os.chdir(workdir)
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+    from main import app
+    from app import db
+    from crypto_utils import CryptoManager
+    logging.disable(logging.CRITICAL)
+    with app.app_context():
+        db.create_all()
+
+    seed(app, args.users, args.rooms, args.messages)
+
+    results = bench_crypto(CryptoManager(), args.crypto_sizes, args.crypto_iterations)
+    results.update(bench_views(app, args.requests, room_id=1))
+
+    _print(results, baseline)
+
+    if args.output:
+        report = {
+            'commit': _git_commit(),
+            'created_at': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': vars(args),
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
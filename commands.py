@@ -0,0 +1,461 @@
+import gzip
+import json
+import sys
+import time
+import click
+from datetime import datetime
+from cryptography.fernet import Fernet, InvalidToken
+from flask.cli import AppGroup
+from sqlalchemy.schema import CreateColumn
+from app import db
+from models import User, Message, Room, JobCheckpoint, SearchToken
+import queries
+from crypto_utils import crypto_manager, compact_ciphertext, write_keyring, room_key_id, LEGACY_CIPHERTEXT_PREFIX, KEYRING_CHECK_INTERVAL
+import logging
+
+logger = logging.getLogger(__name__)
+
+messages_cli = AppGroup('messages', help='Message storage maintenance commands.')
+schema_cli = AppGroup('schema', help='Database schema management commands.')
+rooms_cli = AppGroup('rooms', help='Room archive and retention commands.')
+
+# Version of the NDJSON room archive layout
+ARCHIVE_FORMAT = 1
+
+def _open_archive(path, mode, compress):
+    """Open an archive path (or - for stdio) as text, gzip-compressed if asked or *.gz"""
+    if path == '-':
+        stream = sys.stdout.buffer if 'w' in mode else sys.stdin.buffer
+        if compress:
+            return gzip.open(stream, mode + 't', encoding='utf-8')
+        return open(stream.fileno(), mode, encoding='utf-8', closefd=False)
+    if compress or path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+@schema_cli.command('upgrade')
+def schema_upgrade_command():
+    """Create missing tables, then add missing columns and indexes in place
+
+    Only additive changes are handled. New columns must be nullable or carry
+    a server default so existing rows stay valid.
+    """
+    db.create_all()
+    
+    inspector = db.inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    raise click.ClickException(f"Cannot add NOT NULL column {table.name}.{column.name} without a server default")
+                ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                connection.exec_driver_sql(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}")
+                click.echo(f"Added column {table.name}.{column.name}")
+    
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    
+    click.echo("Schema is up to date.")
+
+@messages_cli.command('compact-ciphertext')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows rewritten per transaction.')
+def compact_ciphertext_command(batch_size):
+    """Rewrite legacy double-base64 ciphertext rows in the compact format
+
+    Rows are walked in primary-key order and committed one batch at a time,
+    so the command can be interrupted and re-run safely.
+    """
+    last_id = 0
+    total = 0
+
+    while True:
+        rows = db.session.execute(
+            db.select(Message.id, Message.content_encrypted)
+            .where(Message.id > last_id, Message.content_encrypted.startswith(LEGACY_CIPHERTEXT_PREFIX))
+            .order_by(Message.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+
+        db.session.execute(
+            db.update(Message),
+            [{'id': row.id, 'content_encrypted': compact_ciphertext(row.content_encrypted)} for row in rows]
+        )
+        db.session.commit()
+
+        last_id = rows[-1].id
+        total += len(rows)
+        click.echo(f"Compacted {total} messages (last id {last_id})")
+
+    logger.info(f"Ciphertext compaction finished, {total} rows rewritten")
+    click.echo(f"Done. {total} messages rewritten.")
+
+@messages_cli.command('create-indexes')
+def create_indexes_command():
+    """Create any Message indexes missing from an existing database
+
+    db.create_all() only adds indexes together with new tables, so databases
+    created before an index was declared need this once.
+    """
+    for index in Message.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+        click.echo(f"Ensured index {index.name}")
+
+@messages_cli.command('rotate-room-key')
+@click.argument('room_id', type=int)
+def rotate_room_key_command(room_id):
+    """Switch a room to a freshly derived key for new messages
+
+    Existing messages keep their key_id and stay readable. Workers pick up the
+    new version when their membership cache entries expire.
+    """
+    room = db.session.get(Room, room_id)
+    if room is None:
+        raise click.ClickException(f"Room {room_id} not found")
+    
+    room.key_version += 1
+    db.session.commit()
+    logger.info(f"Room {room_id} key rotated to version {room.key_version}")
+    click.echo(f"Room {room_id} now encrypts with key version {room.key_version}.")
+
+@messages_cli.command('rotate-master-key')
+def rotate_master_key_command():
+    """Add a new primary master key, keeping older keys for decryption
+
+    Running workers notice the changed keyring within KEYRING_CHECK_INTERVAL
+    seconds and switch new writes to the new key. Follow up with
+    'messages reencrypt', 'messages rebuild-search-index' and then
+    'messages retire-master-keys'.
+    """
+    new_key = Fernet.generate_key()
+    write_keyring(crypto_manager.key_file_path, [new_key] + crypto_manager.master_keys)
+    crypto_manager.reload_master_key()
+    logger.info(f"Master key rotated, new primary {crypto_manager.primary_key_fingerprint()}")
+    click.echo(f"New primary key {crypto_manager.primary_key_fingerprint()}; "
+               f"{len(crypto_manager.master_keys) - 1} older key(s) kept for decryption.")
+    click.echo(f"Wait {KEYRING_CHECK_INTERVAL}s for workers to reload before running 'messages reencrypt'.")
+
+@messages_cli.command('reencrypt')
+@click.option('--batch-size', default=500, show_default=True, help='Rows re-encrypted per transaction.')
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to sleep between batches.')
+@click.option('--restart', is_flag=True, help='Ignore the saved checkpoint and start from the first row.')
+def reencrypt_command(batch_size, pause, restart):
+    """Re-encrypt every message under the current primary master key
+
+    Progress is checkpointed per primary key in the same transaction as each
+    batch, so the job can be stopped and resumed at any time. Short batches
+    and --pause keep lock times and I/O low on a live database.
+    """
+    fingerprint = crypto_manager.primary_key_fingerprint()
+    name = f"reencrypt:{fingerprint}"
+    checkpoint = db.session.get(JobCheckpoint, name)
+    if checkpoint is None:
+        checkpoint = JobCheckpoint(name=name, position=0)
+        db.session.add(checkpoint)
+        db.session.commit()
+    elif restart:
+        checkpoint.position = 0
+        checkpoint.completed_at = None
+        db.session.commit()
+    elif checkpoint.completed_at is not None:
+        click.echo(f"All messages already re-encrypted under {fingerprint}.")
+        return
+    
+    total = 0
+    failures = 0
+    while True:
+        if crypto_manager.primary_key_fingerprint() != fingerprint:
+            raise click.ClickException("Primary key changed while re-encrypting; run the command again")
+        
+        rows = db.session.execute(
+            db.select(Message.id, Message.content_encrypted, Message.key_id)
+            .where(Message.id > checkpoint.position)
+            .order_by(Message.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        
+        updates = []
+        for row in rows:
+            try:
+                updates.append({'id': row.id, 'content_encrypted': crypto_manager.rotate_token(row.content_encrypted, row.key_id)})
+            except InvalidToken:
+                failures += 1
+                logger.error(f"Message {row.id} cannot be decrypted with any known key")
+        
+        if updates:
+            db.session.execute(db.update(Message), updates)
+        checkpoint.position = rows[-1].id
+        db.session.commit()
+        
+        total += len(updates)
+        click.echo(f"Re-encrypted {total} messages (last id {checkpoint.position})")
+        if pause:
+            time.sleep(pause)
+    
+    if failures:
+        raise click.ClickException(f"{failures} messages could not be decrypted; old keys must not be retired")
+    
+    checkpoint.completed_at = datetime.utcnow()
+    db.session.commit()
+    click.echo(f"Done. {total} messages re-encrypted under {fingerprint}.")
+
+@messages_cli.command('retire-master-keys')
+def retire_master_keys_command():
+    """Drop every master key except the primary once re-encryption has finished
+
+    Search tokens are keyed per master key and queries only use the keys
+    still in the keyring, so the full search index must also have been
+    rebuilt under the primary key or older messages would stop matching.
+    """
+    fingerprint = crypto_manager.primary_key_fingerprint()
+    checkpoint = db.session.get(JobCheckpoint, f"reencrypt:{fingerprint}")
+    if checkpoint is None or checkpoint.completed_at is None:
+        raise click.ClickException(f"Run 'messages reencrypt' to completion for {fingerprint} first")
+    checkpoint = db.session.get(JobCheckpoint, f"search-index:{fingerprint}:all")
+    if checkpoint is None or checkpoint.completed_at is None:
+        raise click.ClickException(f"Run 'messages rebuild-search-index' (without --room-id) to completion for {fingerprint} first")
+    
+    retired = len(crypto_manager.master_keys) - 1
+    write_keyring(crypto_manager.key_file_path, [crypto_manager.master_key])
+    crypto_manager.reload_master_key()
+    click.echo(f"Retired {retired} old master key(s).")
+
+@messages_cli.command('rebuild-search-index')
+@click.option('--room-id', type=int, help='Only rebuild this room.')
+@click.option('--batch-size', default=500, show_default=True, help='Messages indexed per transaction.')
+@click.option('--restart', is_flag=True, help='Ignore the saved checkpoint and start from the first row.')
+def rebuild_search_index_command(room_id, batch_size, restart):
+    """Rebuild blind search tokens under the current primary key
+
+    Messages are decrypted in id-ordered batches; each batch replaces its
+    tokens and advances the checkpoint in one transaction, so the job can be
+    resumed and memory stays flat.
+    """
+    from search import index_rows
+    
+    name = f"search-index:{crypto_manager.primary_key_fingerprint()}:{room_id or 'all'}"
+    checkpoint = db.session.get(JobCheckpoint, name)
+    if checkpoint is None:
+        checkpoint = JobCheckpoint(name=name, position=0)
+        db.session.add(checkpoint)
+    elif restart:
+        checkpoint.position = 0
+        checkpoint.completed_at = None
+    db.session.commit()
+    
+    total = 0
+    while True:
+        statement = (db.select(Message.id, Message.room_id, Message.content_encrypted, Message.key_id)
+                     .where(Message.id > checkpoint.position)
+                     .order_by(Message.id)
+                     .limit(batch_size))
+        if room_id is not None:
+            statement = statement.where(Message.room_id == room_id)
+        rows = db.session.execute(statement).all()
+        if not rows:
+            break
+        
+        results = crypto_manager.decrypt_many([row.content_encrypted for row in rows],
+                                              key_ids=[row.key_id for row in rows])
+        db.session.execute(db.delete(SearchToken).where(SearchToken.message_id.in_([row.id for row in rows])))
+        index_rows([{'id': row.id, 'room_id': row.room_id, 'content': result.value}
+                    for row, result in zip(rows, results) if result.ok])
+        checkpoint.position = rows[-1].id
+        db.session.commit()
+        
+        total += len(rows)
+        click.echo(f"Indexed {total} messages (last id {checkpoint.position})")
+    
+    checkpoint.completed_at = datetime.utcnow()
+    db.session.commit()
+    click.echo(f"Done. {total} messages indexed.")
+
+@rooms_cli.command('export')
+@click.argument('room_id', type=int)
+@click.argument('output')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows fetched and decrypted per batch.')
+@click.option('--compress', is_flag=True, help='Gzip the output (implied by a .gz file name).')
+def export_room_command(room_id, output, batch_size, compress):
+    """Stream a room's messages to OUTPUT (or -) as plaintext NDJSON
+
+    Rows are read through a server-side cursor with yield_per and decrypted
+    one batch at a time, so memory stays flat however large the room is.
+    The archive holds decrypted messages; protect it accordingly.
+    """
+    room = db.session.get(Room, room_id)
+    if room is None:
+        raise click.ClickException(f"Room {room_id} not found")
+    
+    statement = (db.select(Message.message_id, Message.timestamp, Message.content_encrypted, Message.key_id, User.username)
+                 .join(User, User.id == Message.sender_id)
+                 .where(Message.room_id == room_id)
+                 .order_by(Message.id)
+                 .execution_options(yield_per=batch_size))
+    
+    total = 0
+    failures = 0
+    with _open_archive(output, 'w', compress) as archive:
+        archive.write(json.dumps({'format': ARCHIVE_FORMAT, 'room': {'name': room.name, 'description': room.description}}) + '\n')
+        for rows in db.session.execute(statement).partitions():
+            results = crypto_manager.decrypt_many([row.content_encrypted for row in rows],
+                                                  key_ids=[row.key_id for row in rows])
+            for row, result in zip(rows, results):
+                if not result.ok:
+                    failures += 1
+                    continue
+                archive.write(json.dumps({
+                    'message_id': row.message_id,
+                    'sender': row.username,
+                    'timestamp': row.timestamp.isoformat() if row.timestamp else None,
+                    'content': result.value
+                }) + '\n')
+            total += len(rows)
+            click.echo(f"Exported {total} messages", err=True)
+    
+    if failures:
+        click.echo(f"Skipped {failures} messages that could not be decrypted", err=True)
+    click.echo(f"Done. {total - failures} messages exported from room {room_id}.", err=True)
+
+def _import_batch(room, batch, sender_ids):
+    """Encrypt and insert one batch of archive records, skipping known message_ids"""
+    from search import index_rows
+    
+    existing = set(db.session.scalars(
+        db.select(Message.message_id).where(Message.message_id.in_([record['message_id'] for record in batch]))
+    ))
+    
+    missing_senders = {record['sender'] for record in batch} - sender_ids.keys()
+    if missing_senders:
+        for user_id, username in db.session.execute(db.select(User.id, User.username).where(User.username.in_(missing_senders))):
+            sender_ids[username] = user_id
+    
+    key_id = room_key_id(room.id, room.key_version)
+    records = [record for record in batch if record['message_id'] not in existing and record['sender'] in sender_ids]
+    if not records:
+        return 0
+    
+    results = crypto_manager.encrypt_many([record['content'] for record in records], key_ids=key_id)
+    rows = [{
+        'content_encrypted': result.value,
+        'key_id': key_id,
+        'sender_id': sender_ids[record['sender']],
+        'room_id': room.id,
+        'message_id': record['message_id'],
+        'timestamp': datetime.fromisoformat(record['timestamp']) if record.get('timestamp') else datetime.utcnow(),
+        'content': record['content']
+    } for record, result in zip(records, results)]
+    
+    queries.assign_room_seqs(rows)
+    columns = {column.key for column in Message.__table__.columns}
+    ids = db.session.scalars(
+        db.insert(Message).returning(Message.id, sort_by_parameter_order=True),
+        [{key: value for key, value in row.items() if key in columns} for row in rows]
+    ).all()
+    for row, message_id in zip(rows, ids):
+        row['id'] = message_id
+    index_rows(rows)
+    db.session.commit()
+    return len(rows)
+
+@rooms_cli.command('import')
+@click.argument('room_id', type=int)
+@click.argument('source')
+@click.option('--batch-size', default=1000, show_default=True, help='Messages inserted per transaction.')
+@click.option('--compress', is_flag=True, help='Read gzip input (implied by a .gz file name).')
+def import_room_command(room_id, source, batch_size, compress):
+    """Load an NDJSON archive from SOURCE (or -) into an existing room
+
+    Messages are re-encrypted under the room's current key and inserted with
+    executemany in batches. Messages whose message_id already exists are
+    skipped, so an interrupted import can simply be re-run. Senders are
+    matched by username; messages from unknown users are skipped.
+    """
+    room = db.session.get(Room, room_id)
+    if room is None:
+        raise click.ClickException(f"Room {room_id} not found")
+    
+    sender_ids = {}
+    batch = []
+    read = 0
+    inserted = 0
+    with _open_archive(source, 'r', compress) as archive:
+        for line in archive:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'format' in record:
+                if record['format'] != ARCHIVE_FORMAT:
+                    raise click.ClickException(f"Unsupported archive format {record['format']}")
+                continue
+            
+            batch.append(record)
+            read += 1
+            if len(batch) >= batch_size:
+                inserted += _import_batch(room, batch, sender_ids)
+                batch = []
+                click.echo(f"Read {read} messages, inserted {inserted}", err=True)
+        
+        if batch:
+            inserted += _import_batch(room, batch, sender_ids)
+    
+    click.echo(f"Done. {inserted} of {read} messages imported into room {room_id}.", err=True)
+
+@rooms_cli.command('set-retention')
+@click.argument('room_id', type=int)
+@click.option('--max-age-days', type=int, help='Delete messages older than this many days (0 clears).')
+@click.option('--max-messages', type=int, help='Keep only the newest N messages (0 clears).')
+def set_retention_command(room_id, max_age_days, max_messages):
+    """Set or clear a room's retention policy"""
+    room = db.session.get(Room, room_id)
+    if room is None:
+        raise click.ClickException(f"Room {room_id} not found")
+    
+    if max_age_days is not None:
+        room.retention_days = max_age_days or None
+    if max_messages is not None:
+        room.retention_max_messages = max_messages or None
+    db.session.commit()
+    click.echo(f"Room {room_id} retention: max age {room.retention_days or 'unlimited'} days, "
+               f"max {room.retention_max_messages or 'unlimited'} messages")
+
+@rooms_cli.command('enforce-retention')
+@click.option('--room-id', type=int, help='Only enforce this room.')
+def enforce_retention_command(room_id):
+    """Run retention policies now instead of waiting for the background job"""
+    from retention import retention_engine
+    
+    if room_id is not None:
+        room = db.session.get(Room, room_id)
+        if room is None:
+            raise click.ClickException(f"Room {room_id} not found")
+        deleted = retention_engine.enforce_room(room)
+    else:
+        deleted = retention_engine.enforce()
+    click.echo(f"Done. {deleted} messages deleted.")
+
+@rooms_cli.command('delete')
+@click.argument('room_id', type=int)
+@click.confirmation_option(prompt='Delete this room and all of its messages?')
+def delete_room_command(room_id):
+    """Delete a room, its memberships and its messages in bulk"""
+    from retention import retention_engine
+    
+    if db.session.get(Room, room_id) is None:
+        raise click.ClickException(f"Room {room_id} not found")
+    db.session.rollback()
+    deleted = retention_engine.delete_room(room_id)
+    click.echo(f"Deleted room {room_id} and {deleted} messages.")
+
+def register_commands(app):
+    """Attach the CLI command groups to the app"""
+    app.cli.add_command(messages_cli)
+    app.cli.add_command(schema_cli)
+    app.cli.add_command(rooms_cli)
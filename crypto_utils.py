@@ -1,78 +1,379 @@
 import os
-from cryptography.fernet import Fernet
+import time
+import hashlib
+import hmac
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import base64
 import logging
+import sys
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
 
 logger = logging.getLogger(__name__)
 
+# Outcome of one item in a batch operation; ``value`` is None when ``ok`` is False
+BatchResult = namedtuple('BatchResult', ['ok', 'value', 'error'])
+
+# Stored ciphertext formats. Current rows hold the Fernet token as-is; its
+# leading version byte (0x80) always encodes to "gAAAAA". Legacy rows wrapped
+# the token in a second layer of urlsafe base64, which encodes to "Z0FBQUFB".
+LEGACY_CIPHERTEXT_PREFIX = "Z0FBQUFB"
+
+def is_legacy_ciphertext(stored):
+    """Return True for rows written in the double-base64 legacy format"""
+    return stored.startswith(LEGACY_CIPHERTEXT_PREFIX)
+
+def compact_ciphertext(stored):
+    """Convert a stored ciphertext to the compact format without decrypting it"""
+    if is_legacy_ciphertext(stored):
+        return base64.urlsafe_b64decode(stored.encode('utf-8')).decode('utf-8')
+    return stored
+
+def _token_bytes(stored):
+    """Return the Fernet token for a stored ciphertext in either format"""
+    if is_legacy_ciphertext(stored):
+        return base64.urlsafe_b64decode(stored.encode('utf-8'))
+    return stored.encode('utf-8')
+
+def room_key_id(room_id, key_version):
+    """Key id stored on messages encrypted under a room's derived key"""
+    return f"room:{room_id}:v{key_version}"
+
+def _expand_key_ids(key_ids, count):
+    """Normalize a batch key_ids argument to one entry per item"""
+    if key_ids is None or isinstance(key_ids, str):
+        return [key_ids] * count
+    return list(key_ids)
+
+# Master keyring file, one key per line with the primary key first
+MASTER_KEY_FILE = os.getenv("MASTER_KEY_FILE", "master.key")
+
+# Seconds between checks for a keyring file changed by another process
+KEYRING_CHECK_INTERVAL = int(os.getenv("KEYRING_CHECK_INTERVAL", 30))
+
+# Batches smaller than this are processed inline even when workers are requested
+PARALLEL_BATCH_THRESHOLD = 512
+
+class PlaintextCache:
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024):
+        """Initialize a thread-safe LRU cache bounded by entry count and total bytes"""
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _entry_size(key, value):
+        return sys.getsizeof(key) + sys.getsizeof(value)
+    
+    def get(self, key):
+        """Return the cached plaintext for key, or None on a miss"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def put(self, key, value):
+        """Store plaintext for key, evicting least recently used entries as needed"""
+        size = self._entry_size(key, value)
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= self._entry_size(key, previous)
+            
+            self._entries[key] = value
+            self._bytes += size
+            
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                old_key, old_value = self._entries.popitem(last=False)
+                self._bytes -= self._entry_size(old_key, old_value)
+                self.evictions += 1
+    
+    def clear(self):
+        """Drop every cached entry (counters are kept)"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+    
+    def stats(self):
+        """Return a snapshot of cache size and hit/miss counters"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+class RoomCipherCache:
+    def __init__(self, build_cipher, max_entries=1024):
+        """Initialize a bounded LRU map of key id to derived room cipher
+        
+        ``clear`` starts a new keyring generation; a cipher derived during an
+        older generation is never cached, since it may come from the old keys.
+        """
+        self.build_cipher = build_cipher
+        self.max_entries = max_entries
+        self._ciphers = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+    
+    def get(self, key_id):
+        """Return the cipher for key_id, deriving it on first use"""
+        while True:
+            with self._lock:
+                cipher = self._ciphers.get(key_id)
+                if cipher is not None:
+                    self._ciphers.move_to_end(key_id)
+                    return cipher
+                generation = self._generation
+            
+            # Derive outside the lock; a racing thread computes the same key
+            cipher = self.build_cipher(key_id)
+            with self._lock:
+                if generation != self._generation:
+                    continue  # The keyring was replaced mid-derivation; derive again
+                self._ciphers[key_id] = cipher
+                while len(self._ciphers) > self.max_entries:
+                    self._ciphers.popitem(last=False)
+            return cipher
+    
+    def clear(self):
+        """Forget every derived cipher and start a new generation"""
+        with self._lock:
+            self._ciphers.clear()
+            self._generation += 1
+
+def key_fingerprint(key):
+    """Short, non-secret identifier for a master key"""
+    return hashlib.sha256(key).hexdigest()[:12]
+
+def read_keyring(path):
+    """Read master keys from a keyring file, newest (primary) first
+
+    The file holds one Fernet key per line. A single-line file is the
+    original ``master.key`` layout and remains valid.
+    """
+    with open(path, "rb") as key_file:
+        return [line.strip() for line in key_file.read().splitlines() if line.strip()]
+
+def write_keyring(path, keys):
+    """Atomically replace a keyring file"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as key_file:
+        key_file.write(b"\n".join(keys) + b"\n")
+    os.replace(temp_path, path)
+
 class CryptoManager:
-    def __init__(self):
-        """Initialize the crypto manager with a master key"""
-        self.master_key = self._load_or_generate_master_key()
-        self.cipher = Fernet(self.master_key)
-    
-    def _load_or_generate_master_key(self):
-        """Load existing master key or generate a new one"""
-        key_file_path = "master.key"
+    def __init__(self, key_file_path=None):
+        """Initialize the crypto manager; the master keyring is read on first use"""
+        self.key_file_path = key_file_path or MASTER_KEY_FILE
+        self._master_keys = None
+        self._cipher = None
+        self._load_lock = threading.Lock()
+        self._room_ciphers = RoomCipherCache(self._build_room_cipher)
+        self._search_keys = RoomCipherCache(self._derive_search_key)
+        self.plaintext_cache = PlaintextCache(
+            max_entries=int(os.getenv("MESSAGE_CACHE_MAX_ENTRIES", 10000)),
+            max_bytes=int(os.getenv("MESSAGE_CACHE_MAX_BYTES", 16 * 1024 * 1024)),
+        )
+        self._keyring_mtime = None
+        self._next_keyring_check = 0
+    
+    def init_app(self, app):
+        """Take the keyring location from app config, resolving relative paths against the app root"""
+        key_file_path = os.path.join(app.root_path, app.config.get("MASTER_KEY_FILE", MASTER_KEY_FILE))
+        if key_file_path != self.key_file_path:
+            with self._load_lock:
+                self.key_file_path = key_file_path
+                self._master_keys = None
+    
+    def _ensure_loaded(self):
+        if self._master_keys is None:
+            with self._load_lock:
+                if self._master_keys is None:
+                    self._set_master_keys(self._load_or_generate_master_keys())
+    
+    @property
+    def master_keys(self):
+        """Every master key, primary first"""
+        self._ensure_loaded()
+        return self._master_keys
+    
+    @property
+    def master_key(self):
+        """The primary master key, used for new encryptions"""
+        return self.master_keys[0]
+    
+    @property
+    def cipher(self):
+        """MultiFernet over the whole master keyring"""
+        self._ensure_loaded()
+        return self._cipher
+    
+    def _set_master_keys(self, keys):
+        """Install a keyring; the first key encrypts, every key decrypts
+        
+        The keys are swapped in before the derived caches are cleared, so any
+        derivation still running against the old keys is discarded.
+        """
+        self._cipher = MultiFernet([Fernet(key) for key in keys])
+        self._master_keys = keys
+        self._room_ciphers.clear()
+        self._search_keys.clear()
+    
+    def reload_master_key(self):
+        """Reload the master keyring and drop plaintext cached under the old one"""
+        with self._load_lock:
+            self._set_master_keys(self._load_or_generate_master_keys())
+        self.plaintext_cache.clear()
+        logger.info("Master keyring reloaded, room keys and plaintext cache cleared")
+    
+    def refresh_keyring(self, force=False):
+        """Reload the keyring if its file changed since it was last read
+
+        Checks the file at most every KEYRING_CHECK_INTERVAL seconds unless
+        ``force`` is set. Returns True if the keyring was reloaded, which lets
+        a worker pick up a key another worker has started encrypting with.
+        """
+        if self._master_keys is None:
+            return False  # Not loaded yet; first use reads the current file
+        now = time.monotonic()
+        if not force and now < self._next_keyring_check:
+            return False
+        self._next_keyring_check = now + KEYRING_CHECK_INTERVAL
+        
+        try:
+            mtime = os.stat(self.key_file_path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._keyring_mtime:
+            return False
+        
+        self.reload_master_key()
+        return True
+    
+    def primary_key_fingerprint(self):
+        """Fingerprint of the key currently used for encryption"""
+        return key_fingerprint(self.master_key)
+    
+    def _load_or_generate_master_keys(self):
+        """Load the existing master keyring or generate a new one"""
+        key_file_path = self.key_file_path
         
         try:
             if os.path.exists(key_file_path):
-                with open(key_file_path, "rb") as key_file:
-                    key = key_file.read()
-                    logger.info("Loaded existing master key")
-                    return key
+                keys = read_keyring(key_file_path)
+                self._keyring_mtime = os.stat(key_file_path).st_mtime_ns
+                logger.info(f"Loaded {len(keys)} master key(s)")
+                return keys
             else:
                 # Generate new key
                 key = Fernet.generate_key()
-                with open(key_file_path, "wb") as key_file:
-                    key_file.write(key)
+                write_keyring(key_file_path, [key])
+                self._keyring_mtime = os.stat(key_file_path).st_mtime_ns
                 logger.info("Generated new master key")
-                return key
+                return [key]
         except Exception as e:
             logger.error(f"Error handling master key: {e}")
             # Fallback to environment variable or generate temporary key
             env_key = os.getenv("MASTER_ENCRYPTION_KEY")
             if env_key:
-                return base64.urlsafe_b64encode(env_key.encode()[:32].ljust(32, b'\0'))
+                return [base64.urlsafe_b64encode(env_key.encode()[:32].ljust(32, b'\0'))]
             else:
                 logger.warning("Using temporary key - messages will not persist between restarts")
-                return Fernet.generate_key()
+                return [Fernet.generate_key()]
+    
+    def _build_room_cipher(self, key_id):
+        """Room cipher that encrypts under the primary master key's derivation"""
+        return MultiFernet([Fernet(self.generate_room_key(key_id, master_key)) for master_key in self.master_keys])
     
-    def encrypt_message(self, message_text):
-        """Encrypt a message using Fernet cipher"""
+    def _cipher_for(self, key_id):
+        """Return the master cipher, or the derived room cipher for key_id"""
+        self.refresh_keyring()
+        if key_id is None:
+            return self.cipher
+        return self._room_ciphers.get(key_id)
+    
+    def _decrypt_token(self, token, key_id):
+        """Decrypt a Fernet token, re-reading the keyring once if no key matches"""
+        try:
+            return self._cipher_for(key_id).decrypt(token)
+        except InvalidToken:
+            if not self.refresh_keyring(force=True):
+                raise
+            return self._cipher_for(key_id).decrypt(token)
+    
+    def rotate_token(self, encrypted_message, key_id=None):
+        """Re-encrypt a stored ciphertext under the primary key without exposing plaintext"""
+        return self._cipher_for(key_id).rotate(_token_bytes(encrypted_message)).decode('utf-8')
+    
+    def encrypt_message(self, message_text, key_id=None):
+        """Encrypt a message using Fernet cipher
+
+        With ``key_id`` (see ``room_key_id``) the message is encrypted under
+        the derived room key instead of the master key.
+        """
         try:
             if not isinstance(message_text, str):
                 raise ValueError("Message must be a string")
             
             # Encode message to bytes and encrypt
-            message_bytes = message_text.encode('utf-8')
-            encrypted_bytes = self.cipher.encrypt(message_bytes)
+            with metrics.timer('crypto_operation_seconds', scope='crypto', operation='encrypt'):
+                message_bytes = message_text.encode('utf-8')
+                encrypted_bytes = self._cipher_for(key_id).encrypt(message_bytes)
             
-            # Return base64 encoded string for database storage
-            encrypted_string = base64.urlsafe_b64encode(encrypted_bytes).decode('utf-8')
-            logger.debug(f"Successfully encrypted message of length {len(message_text)}")
-            
-            return encrypted_string
+            # The Fernet token is already urlsafe base64, store it as-is
+            return encrypted_bytes.decode('utf-8')
             
         except Exception as e:
             logger.error(f"Error encrypting message: {e}")
             raise CryptoError(f"Failed to encrypt message: {str(e)}")
     
-    def decrypt_message(self, encrypted_message):
-        """Decrypt a message using Fernet cipher"""
+    def decrypt_message(self, encrypted_message, cache_key=None, key_id=None):
+        """Decrypt a message using Fernet cipher
+
+        When ``cache_key`` is given (the immutable ``Message.message_id``), the
+        plaintext is served from and stored in the plaintext cache. ``key_id``
+        is the room key the message was written with; None means the master key.
+        """
+        if cache_key is not None:
+            cached = self.plaintext_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
         try:
             if not encrypted_message:
                 raise ValueError("Encrypted message cannot be empty")
             
-            # Decode from base64 and decrypt
-            encrypted_bytes = base64.urlsafe_b64decode(encrypted_message.encode('utf-8'))
-            decrypted_bytes = self.cipher.decrypt(encrypted_bytes)
+            # Unwrap legacy rows and decrypt
+            with metrics.timer('crypto_operation_seconds', scope='crypto', operation='decrypt'):
+                encrypted_bytes = _token_bytes(encrypted_message)
+                decrypted_bytes = self._decrypt_token(encrypted_bytes, key_id)
             
             # Decode to string
             message_text = decrypted_bytes.decode('utf-8')
-            logger.debug(f"Successfully decrypted message of length {len(message_text)}")
+            
+            if cache_key is not None:
+                self.plaintext_cache.put(cache_key, message_text)
             
             return message_text
             
@@ -80,23 +381,138 @@ class CryptoManager:
             logger.error(f"Error decrypting message: {e}")
             raise CryptoError(f"Failed to decrypt message: {str(e)}")
     
-    def generate_room_key(self, room_id, user_id):
-        """Generate a deterministic key for room-specific encryption (if needed)"""
+    def _encrypt_one(self, item):
+        """Encrypt a (text, key_id) pair without logging or raising; used by the batch API"""
+        message_text, key_id = item
+        try:
+            if not isinstance(message_text, str):
+                raise ValueError("Message must be a string")
+            encrypted_bytes = self._cipher_for(key_id).encrypt(message_text.encode('utf-8'))
+            return BatchResult(True, encrypted_bytes.decode('utf-8'), None)
+        except Exception as e:
+            return BatchResult(False, None, str(e))
+    
+    def _decrypt_one(self, item):
+        """Decrypt a (ciphertext, key_id) pair without logging or raising; used by the batch API"""
+        encrypted_message, key_id = item
         try:
-            # Create a deterministic key based on room and user
-            salt = f"room_{room_id}_user_{user_id}".encode('utf-8')
-            kdf = PBKDF2HMAC(
+            if not encrypted_message:
+                raise ValueError("Encrypted message cannot be empty")
+            encrypted_bytes = _token_bytes(encrypted_message)
+            return BatchResult(True, self._decrypt_token(encrypted_bytes, key_id).decode('utf-8'), None)
+        except Exception as e:
+            return BatchResult(False, None, str(e) or type(e).__name__)
+    
+    def _run_batch(self, func, items, max_workers):
+        """Apply func to items, spreading large batches across a thread pool"""
+        if not max_workers or max_workers < 2 or len(items) < PARALLEL_BATCH_THRESHOLD:
+            return [func(item) for item in items]
+        
+        chunksize = max(1, len(items) // (max_workers * 4))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(func, items, chunksize=chunksize))
+    
+    def encrypt_many(self, messages, key_ids=None, max_workers=None):
+        """Encrypt a sequence of strings, returning one BatchResult per item
+
+        ``key_ids`` is either None (master key), a single key id for the whole
+        batch, or a sequence parallel to ``messages``.
+        """
+        messages = list(messages)
+        metrics.inc('crypto_messages_total', len(messages), operation='encrypt')
+        with metrics.timer('crypto_operation_seconds', scope='crypto', operation='encrypt_batch'):
+            return self._run_batch(self._encrypt_one, list(zip(messages, _expand_key_ids(key_ids, len(messages)))), max_workers)
+    
+    def decrypt_many(self, encrypted_messages, cache_keys=None, key_ids=None, max_workers=None):
+        """Decrypt a sequence of ciphertexts, returning one BatchResult per item
+
+        Failures are reported per item instead of raised. With ``cache_keys``
+        (parallel to ``encrypted_messages``) cached plaintext is reused and
+        newly decrypted plaintext is stored. ``key_ids`` works as in
+        ``encrypt_many``.
+        """
+        encrypted_messages = list(encrypted_messages)
+        items = list(zip(encrypted_messages, _expand_key_ids(key_ids, len(encrypted_messages))))
+        if cache_keys is None:
+            pending = items
+            with metrics.timer('crypto_operation_seconds', scope='crypto', operation='decrypt_batch'):
+                results = self._run_batch(self._decrypt_one, items, max_workers)
+        else:
+            cache_keys = list(cache_keys)
+            results = [None] * len(items)
+            pending = []
+            for index, key in enumerate(cache_keys):
+                cached = self.plaintext_cache.get(key)
+                if cached is not None:
+                    results[index] = BatchResult(True, cached, None)
+                else:
+                    pending.append(index)
+            
+            with metrics.timer('crypto_operation_seconds', scope='crypto', operation='decrypt_batch'):
+                decrypted = self._run_batch(self._decrypt_one, [items[i] for i in pending], max_workers)
+            for index, result in zip(pending, decrypted):
+                results[index] = result
+                if result.ok:
+                    self.plaintext_cache.put(cache_keys[index], result.value)
+        
+        metrics.inc('crypto_messages_total', len(pending), operation='decrypt')
+        failures = sum(1 for result in results if not result.ok)
+        if failures:
+            logger.error(f"Failed to decrypt {failures} of {len(results)} messages in batch")
+        return results
+    
+    def generate_room_key(self, key_id, master_key=None):
+        """Derive the Fernet key for a room key id from a master key with HKDF
+
+        The master key is already uniformly random, so a single HKDF expansion
+        is enough; no password stretching is needed. Defaults to the primary
+        master key.
+        """
+        try:
+            hkdf = HKDF(
                 algorithm=hashes.SHA256(),
                 length=32,
-                salt=salt,
-                iterations=100000,
+                salt=None,
+                info=f"securechat:{key_id}".encode('utf-8'),
             )
-            key = base64.urlsafe_b64encode(kdf.derive(self.master_key))
-            return key
+            return base64.urlsafe_b64encode(hkdf.derive(master_key or self.master_key))
         except Exception as e:
             logger.error(f"Error generating room key: {e}")
             raise CryptoError(f"Failed to generate room key: {str(e)}")
 
+    def _derive_search_key(self, scope):
+        """HMAC key for a room's blind search index under one master key"""
+        room_id, master_key = scope
+        hkdf = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=f"securechat:search:room:{room_id}".encode('utf-8'),
+        )
+        return hkdf.derive(master_key)
+    
+    @staticmethod
+    def _blind_token(search_key, word):
+        return hmac.new(search_key, word.encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+    
+    def blind_tokens(self, room_id, words):
+        """Keyed-HMAC tokens for words under the primary key, for indexing
+
+        Tokens are scoped per room, so equal words in different rooms do not
+        produce linkable tokens.
+        """
+        search_key = self._search_keys.get((room_id, self.master_key))
+        return [self._blind_token(search_key, word) for word in words]
+    
+    def blind_query_tokens(self, room_id, word):
+        """Tokens for a query word under every master key in the keyring
+
+        Rows indexed before a key rotation keep their old tokens until the
+        index is rebuilt, so queries match against all of them.
+        """
+        return [self._blind_token(self._search_keys.get((room_id, master_key)), word)
+                for master_key in self.master_keys]
+
 class CryptoError(Exception):
     """Custom exception for cryptography-related errors"""
     pass
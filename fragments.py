@@ -0,0 +1,44 @@
+import os
+from membership import LocalCacheBackend
+
+class FragmentCache:
+    def __init__(self, backend=None, ttl=300):
+        """Initialize the cache of rendered room message lists on top of a cache backend
+
+        Fragments are rendered the same for every viewer (every message is
+        marked ``message-other``); ``overlay`` applies the per-viewer styling.
+        """
+        self.backend = backend or LocalCacheBackend(max_entries=1000)
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(room_id):
+        return f"fragment:{room_id}"
+
+    def get(self, room_id, last_message_id):
+        """Return the cached ``{'html', 'has_more'}`` entry if it is still current"""
+        entry = self.backend.get(self._key(room_id))
+        if entry is None or entry['last_message_id'] != last_message_id:
+            return None
+        return entry
+
+    def set(self, room_id, last_message_id, html, has_more):
+        """Store the rendered newest page of a room, tagged with its newest message id"""
+        self.backend.set(self._key(room_id), {'last_message_id': last_message_id, 'html': html, 'has_more': has_more}, self.ttl)
+
+    def invalidate(self, room_id):
+        """Drop a room's fragment after its messages change"""
+        self.backend.delete(self._key(room_id))
+
+    @staticmethod
+    def overlay(html, user_id):
+        """Mark the viewer's own messages in a rendered fragment with one string pass
+
+        Message content is HTML-escaped, so it cannot contain the attribute
+        sequence being replaced.
+        """
+        return html.replace(f'data-sender-id="{user_id}" class="message message-other"',
+                            f'data-sender-id="{user_id}" class="message message-own"')
+
+# Global fragment cache instance
+fragment_cache = FragmentCache(ttl=int(os.getenv("FRAGMENT_CACHE_TTL", 300)))
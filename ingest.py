@@ -0,0 +1,156 @@
+import queue
+import threading
+import time
+import atexit
+import logging
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# Ack policies for batched ingestion
+ACK_QUEUED = 'queued'        # Acknowledge once the message is queued in this process
+ACK_COMMITTED = 'committed'  # Acknowledge once the batch holding the message is committed
+
+class IngestQueueFull(Exception):
+    """Raised when the ingestion queue cannot accept more messages"""
+    pass
+
+class MessageIngestor:
+    def __init__(self, batch_size=100, max_delay=0.02, max_queue_size=10000):
+        """Initialize a write-behind queue that inserts messages in group-committed batches"""
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.app = None
+        self.on_commit = None
+        self.before_insert = None
+        self.on_insert = None
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def init_app(self, app, on_commit=None, before_insert=None, on_insert=None):
+        """Bind the ingestor to an app
+
+        ``before_insert(rows)`` runs inside each batch's transaction before the
+        INSERT and may fill in column values; ``on_insert(rows)`` runs in the
+        same transaction once ids are assigned; ``on_commit(rows)`` runs after
+        the batch commits.
+        """
+        self.app = app
+        self.on_commit = on_commit
+        self.before_insert = before_insert
+        self.on_insert = on_insert
+        self.batch_size = app.config.get('MESSAGE_INGEST_BATCH_SIZE', self.batch_size)
+        self.max_delay = app.config.get('MESSAGE_INGEST_MAX_DELAY_MS', self.max_delay * 1000) / 1000
+
+    def _ensure_started(self):
+        # Started lazily so each gunicorn worker gets its own flusher after fork
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name='message-ingestor', daemon=True)
+                self._thread.start()
+
+    def submit(self, row):
+        """Queue a Message insert and return a Future resolved with its id after commit
+
+        ``row`` holds Message column values plus any extra keys needed by
+        ``on_commit``; only Message columns are inserted.
+        """
+        self._ensure_started()
+        future = Future()
+        try:
+            self._queue.put_nowait((row, future))
+        except queue.Full:
+            raise IngestQueueFull("Message ingestion queue is full")
+        return future
+
+    def pending(self):
+        """Approximate number of messages waiting to be flushed"""
+        return self._queue.qsize()
+
+    def _collect_batch(self):
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._collect_batch()
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        """Insert a batch in one transaction, falling back to one row per transaction
+
+        A single bad row (e.g. a reused client ``message_id``) fails the whole
+        insert, so on failure each row is retried alone and only the rows that
+        still fail get the exception.
+        """
+        from app import db
+        from models import Message
+
+        columns = {column.key for column in Message.__table__.columns}
+        rows = [row for row, _ in batch]
+        with self.app.app_context():
+            try:
+                if self.before_insert is not None:
+                    self.before_insert(rows)
+                ids = db.session.scalars(
+                    db.insert(Message).returning(Message.id, sort_by_parameter_order=True),
+                    [{key: value for key, value in row.items() if key in columns} for row in rows]
+                ).all()
+                for row, message_id in zip(rows, ids):
+                    row['id'] = message_id
+                if self.on_insert is not None:
+                    self.on_insert(rows)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                if len(batch) == 1:
+                    logger.error(f"Failed to flush queued message: {e}")
+                    batch[0][1].set_exception(e)
+                    return
+                logger.warning(f"Failed to flush {len(batch)} queued messages, retrying one at a time: {e}")
+                ids = None
+            finally:
+                db.session.remove()
+
+        if ids is None:
+            for item in batch:
+                self._flush([item])
+            return
+
+        for (_, future), message_id in zip(batch, ids):
+            future.set_result(message_id)
+
+        if self.on_commit is not None:
+            try:
+                self.on_commit(rows)
+            except Exception as e:
+                logger.error(f"Post-commit hook failed for ingested batch: {e}")
+
+        logger.debug(f"Flushed {len(batch)} queued messages")
+
+    def stop(self, timeout=5):
+        """Flush whatever is queued and stop the background thread"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+# Global message ingestor instance
+message_ingestor = MessageIngestor()
+atexit.register(message_ingestor.stop)
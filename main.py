@@ -1,4 +1,10 @@
-from app import app
+from app import create_app, db
+
+app = create_app()
 
 if __name__ == '__main__':
+    # The development server creates missing tables; deployments run `schema upgrade`
+    with app.app_context():
+        import models
+        db.create_all()
     app.run(host='0.0.0.0', port=5000, debug=True)
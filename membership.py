@@ -0,0 +1,100 @@
+import os
+import time
+import threading
+import logging
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import queries
+
+logger = logging.getLogger(__name__)
+
+class CacheBackend(ABC):
+    """Key/value store used by MembershipCache
+
+    Multi-worker deployments can share cached memberships by implementing this
+    interface on top of an external store (Redis, memcached, ...). Values are
+    plain lists and dicts so they serialize cleanly.
+    """
+
+    @abstractmethod
+    def get(self, key):
+        """Return the value stored under key, or None if missing or expired"""
+        pass
+
+    @abstractmethod
+    def set(self, key, value, ttl):
+        """Store value under key for ttl seconds"""
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        """Remove key if present"""
+        pass
+
+class LocalCacheBackend(CacheBackend):
+    def __init__(self, max_entries=10000):
+        """Initialize a per-process, thread-safe backend with TTL expiry"""
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+class MembershipCache:
+    def __init__(self, backend=None, ttl=60):
+        """Initialize the cache of each user's rooms on top of a backend"""
+        self.backend = backend or LocalCacheBackend()
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(user_id):
+        return f"rooms:{user_id}"
+
+    def get_user_rooms(self, user_id):
+        """Return the user's rooms as ``{'id', 'name', 'key_version'}`` dicts, in join order"""
+        rooms = self.backend.get(self._key(user_id))
+        if rooms is None:
+            rooms = [{'id': room.id, 'name': room.name, 'key_version': room.key_version}
+                     for room in queries.get_user_rooms(user_id)]
+            self.backend.set(self._key(user_id), rooms, self.ttl)
+        return rooms
+
+    def get_room(self, room_id, user_id):
+        """Return the cached room dict if the user is a member, otherwise None"""
+        for room in self.get_user_rooms(user_id):
+            if room['id'] == room_id:
+                return room
+        return None
+
+    def is_member(self, room_id, user_id):
+        """Check membership against the cached room list"""
+        return self.get_room(room_id, user_id) is not None
+
+    def invalidate(self, user_id):
+        """Drop the cached rooms for a user after their memberships change"""
+        self.backend.delete(self._key(user_id))
+        logger.debug(f"Membership cache invalidated for user {user_id}")
+
+# Global membership cache instance
+membership_cache = MembershipCache(ttl=int(os.getenv("MEMBERSHIP_CACHE_TTL", 60)))
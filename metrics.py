@@ -0,0 +1,251 @@
+import hmac
+import threading
+import time
+import logging
+from bisect import bisect_left
+from contextlib import nullcontext
+from flask import g, has_request_context, request, abort, Response, template_rendered, before_render_template
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, and buckets for the per-request SQL statement count
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+HELP = {
+    'http_requests_total': ('counter', 'Requests handled, by endpoint, method and status'),
+    'http_request_duration_seconds': ('histogram', 'Request handling time by endpoint'),
+    'http_request_sql_statements': ('histogram', 'SQL statements executed per request'),
+    'http_request_sql_seconds': ('histogram', 'Time spent in SQL per request'),
+    'http_request_crypto_seconds': ('histogram', 'Time spent encrypting and decrypting per request'),
+    'http_request_render_seconds': ('histogram', 'Time spent rendering templates per request'),
+    'db_query_duration_seconds': ('histogram', 'SQL statement execution time'),
+    'crypto_operation_seconds': ('histogram', 'CryptoManager operation time by operation'),
+    'crypto_messages_total': ('counter', 'Messages passed through CryptoManager by operation'),
+}
+
+_NULL_TIMER = nullcontext()
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'scope', 'labels', 'start')
+
+    def __init__(self, metrics, name, scope, labels):
+        self.metrics = metrics
+        self.name = name
+        self.scope = scope
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.metrics.observe(self.name, elapsed, **self.labels)
+        if self.scope is not None:
+            self.metrics.add_to_request(self.scope, elapsed)
+        return False
+
+class Metrics:
+    def __init__(self, enabled=False):
+        """Initialize an in-process registry of counters and histograms"""
+        self.enabled = enabled
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self._buckets = {'http_request_sql_statements': COUNT_BUCKETS}
+        self._collected = {}   # name -> (type, help, callable returning {labels: value})
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        """Add to a counter"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """Record one histogram sample"""
+        if not self.enabled:
+            return
+        buckets = self._buckets.get(name, DEFAULT_BUCKETS)
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            index = bisect_left(buckets, value)
+            if index < len(buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def timer(self, name, scope=None, **labels):
+        """Context manager observing elapsed seconds; scope also adds it to the current request"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, scope, labels)
+
+    def add_to_request(self, scope, value):
+        """Accumulate a per-request total (sql, crypto, render) while handling a request"""
+        if has_request_context() and hasattr(g, '_metrics'):
+            g._metrics[scope] = g._metrics.get(scope, 0) + value
+
+    def register_gauge(self, name, help_text, collect):
+        """Expose a value read at scrape time; collect() returns {labels tuple: value}"""
+        self._collected[name] = ('gauge', help_text, collect)
+    
+    def register_counter(self, name, help_text, collect):
+        """Expose a monotonically increasing total kept elsewhere, read at scrape time"""
+        self._collected[name] = ('counter', help_text, collect)
+
+    def reset(self):
+        """Drop every recorded sample"""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(entry[0]), entry[1], entry[2])) for key, entry in self._histograms.items())
+
+        lines = []
+        seen = set()
+
+        def header(name, default_type):
+            if name not in seen:
+                seen.add(name)
+                metric_type, help_text = HELP.get(name, (default_type, name))
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {metric_type}')
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+
+        for (name, labels), (counts, total, count) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets.get(name, DEFAULT_BUCKETS), counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_format_labels(labels, ("le", bound))} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(labels, ("le", "+Inf"))} {count}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+
+        for name, (metric_type, help_text, collect) in sorted(self._collected.items()):
+            try:
+                values = collect()
+            except Exception as e:
+                logger.error(f"Failed to collect {metric_type} {name}: {e}")
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in values.items():
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def init_app(self, app):
+        """Install request, SQL and template hooks and the /metrics endpoint
+
+        With METRICS_ENABLED off (the default) nothing is installed, so the
+        only remaining cost is the ``enabled`` check in ``timer``, ``inc`` and
+        ``observe``. With METRICS_TOKEN set, /metrics requires
+        ``Authorization: Bearer <token>``.
+        """
+        self.enabled = app.config.get('METRICS_ENABLED', self.enabled)
+        if not self.enabled:
+            return
+
+        from app import db
+        from crypto_utils import crypto_manager
+        from ingest import message_ingestor
+        from realtime import message_hub
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            context._metrics_start = time.perf_counter()
+
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - context._metrics_start
+            self.observe('db_query_duration_seconds', elapsed)
+            if has_request_context() and hasattr(g, '_metrics'):
+                g._metrics['sql'] = g._metrics.get('sql', 0) + elapsed
+                g._metrics['statements'] = g._metrics.get('statements', 0) + 1
+
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        db.event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+
+        def before_render(sender, template, context, **extra):
+            stats = g.get('_metrics')
+            if stats is not None:
+                stats['render_start'] = time.perf_counter()
+
+        def rendered(sender, template, context, **extra):
+            stats = g.get('_metrics')
+            start = stats.pop('render_start', None) if stats is not None else None
+            if start is not None:
+                stats['render'] = stats.get('render', 0) + time.perf_counter() - start
+
+        before_render_template.connect(before_render, app, weak=False)
+        template_rendered.connect(rendered, app, weak=False)
+
+        @app.before_request
+        def start_request_timer():
+            g._metrics = {'start': time.perf_counter()}
+
+        @app.after_request
+        def record_request(response):
+            stats = g.pop('_metrics', None)
+            if stats is None:
+                return response
+            elapsed = time.perf_counter() - stats['start']
+            endpoint = request.endpoint or 'unmatched'
+            self.inc('http_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+            self.observe('http_request_duration_seconds', elapsed, endpoint=endpoint)
+            self.observe('http_request_sql_statements', stats.get('statements', 0), endpoint=endpoint)
+            self.observe('http_request_sql_seconds', stats.get('sql', 0), endpoint=endpoint)
+            self.observe('http_request_crypto_seconds', stats.get('crypto', 0), endpoint=endpoint)
+            self.observe('http_request_render_seconds', stats.get('render', 0), endpoint=endpoint)
+            response.headers['Server-Timing'] = (
+                f"db;dur={stats.get('sql', 0) * 1000:.2f}, crypto;dur={stats.get('crypto', 0) * 1000:.2f}, "
+                f"render;dur={stats.get('render', 0) * 1000:.2f}, total;dur={elapsed * 1000:.2f}"
+            )
+            return response
+
+        self.register_gauge('plaintext_cache_entries', 'Decrypted messages held in the plaintext cache',
+                            lambda: {(): crypto_manager.plaintext_cache.stats()['entries']})
+        self.register_gauge('plaintext_cache_bytes', 'Approximate bytes held in the plaintext cache',
+                            lambda: {(): crypto_manager.plaintext_cache.stats()['bytes']})
+        self.register_counter('plaintext_cache_lookups_total', 'Plaintext cache lookups since startup by result',
+                              lambda: {(('result', key),): value for key, value in crypto_manager.plaintext_cache.stats().items()
+                                       if key in ('hits', 'misses')})
+        self.register_gauge('message_ingest_pending', 'Messages queued for batched ingestion',
+                            lambda: {(): message_ingestor.pending()})
+        self.register_gauge('stream_subscribers', 'Open message stream connections',
+                            lambda: {(): message_hub.subscriber_count()})
+
+        token = app.config.get('METRICS_TOKEN')
+        if not token:
+            logger.warning("METRICS_TOKEN is not set; /metrics is readable by anyone who can reach the app")
+
+        def metrics_endpoint():
+            if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+                abort(404)
+            return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+        app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
+
+# Global metrics registry
+metrics = Metrics()
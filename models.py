@@ -11,6 +11,7 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_online = db.Column(db.Boolean, default=False)
+    last_seen = db.Column(db.DateTime)  # Stamped by each worker's presence flush
     
     # Relationships
     sent_messages = db.relationship('Message', foreign_keys='Message.sender_id', backref='sender', lazy='dynamic')
@@ -38,8 +39,12 @@ class Room(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     created_by_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     is_private = db.Column(db.Boolean, default=False)
+    key_version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # Current room key, see crypto_utils.room_key_id
+    retention_days = db.Column(db.Integer)  # Delete messages older than this many days; NULL keeps them
+    retention_max_messages = db.Column(db.Integer)  # Keep only the newest N messages; NULL keeps them all
+    message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Messages ever posted; never decremented
     
-    # Relationships
+    # Relationships; delete rooms through retention.delete_room, which avoids loading every message
     messages = db.relationship('Message', backref='room', lazy='dynamic', cascade='all, delete-orphan')
     members = db.relationship('RoomMember', backref='room', lazy='dynamic', cascade='all, delete-orphan')
     creator = db.relationship('User', backref='created_rooms')
@@ -51,7 +56,7 @@ class Room(db.Model):
     def add_member(self, user):
         """Add a user to the room"""
         if not self.is_member(user):
-            membership = RoomMember(user_id=user.id, room_id=self.id)
+            membership = RoomMember(user_id=user.id, room_id=self.id, read_count=self.message_count or 0)
             db.session.add(membership)
             return True
         return False
@@ -68,7 +73,10 @@ class RoomMember(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=False)
     joined_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_read_message_id = db.Column(db.Integer)  # Newest message the user has seen in the room
+    read_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # room_seq of last_read_message_id
     
+    # Leading user_id column also serves the per-user unread count query
     __table_args__ = (db.UniqueConstraint('user_id', 'room_id'),)
 
 class Message(db.Model):
@@ -78,6 +86,35 @@ class Message(db.Model):
     room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     message_id = db.Column(db.String(36), unique=True, default=lambda: str(uuid.uuid4()))
+    key_id = db.Column(db.String(64))  # Room key used for content_encrypted; NULL means the master key
+    room_seq = db.Column(db.Integer)  # Position in the room, taken from Room.message_count on insert; NULL for older rows
+    
+    # Room history is always read newest-first within a room
+    __table_args__ = (
+        db.Index('ix_message_room_id_id', 'room_id', 'id'),
+        db.Index('ix_message_room_id_timestamp', 'room_id', 'timestamp'),
+    )
     
     def __repr__(self):
         return f'<Message {self.id} from {self.sender.username}>'
+
+class JobCheckpoint(db.Model):
+    """Progress marker that lets long-running maintenance jobs resume"""
+    name = db.Column(db.String(100), primary_key=True)
+    position = db.Column(db.Integer, nullable=False, default=0)  # Last processed primary key
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    completed_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<JobCheckpoint {self.name} at {self.position}>'
+
+class SearchToken(db.Model):
+    """Blind index entry: a keyed-HMAC token for one word of one message"""
+    id = db.Column(db.Integer, primary_key=True)
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=False)
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=False, index=True)
+    token = db.Column(db.String(32), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_search_token_room_id_token', 'room_id', 'token', 'message_id'),
+    )
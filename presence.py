@@ -0,0 +1,138 @@
+import threading
+import time
+import atexit
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+class PresenceTracker:
+    def __init__(self, ttl=60, flush_interval=30):
+        """Initialize an in-memory presence tracker with heartbeat expiry"""
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.app = None
+        self._users = {}  # user_id -> {'username', 'last_seen', 'rooms': {room_id: last_seen}}
+        self._active = set()     # Users with a heartbeat since the last flush
+        self._departed = set()   # Users who logged out since the last flush
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def init_app(self, app):
+        """Bind the tracker to an app so it can persist User.is_online"""
+        self.app = app
+        self.ttl = app.config.get('PRESENCE_TTL', self.ttl)
+        self.flush_interval = app.config.get('PRESENCE_FLUSH_INTERVAL', self.flush_interval)
+
+    def _ensure_started(self):
+        # Started lazily so each gunicorn worker gets its own flusher after fork
+        if self.app is None or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name='presence-flusher', daemon=True)
+                self._thread.start()
+
+    def heartbeat(self, user_id, username, room_id=None):
+        """Record that a user is active, optionally in a specific room"""
+        self._ensure_started()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = self._users[user_id] = {'username': username, 'last_seen': now, 'rooms': {}}
+            entry['last_seen'] = now
+            self._active.add(user_id)
+            self._departed.discard(user_id)
+            if room_id is not None:
+                entry['rooms'][room_id] = now
+
+    def disconnect(self, user_id):
+        """Mark a user offline immediately, e.g. on logout"""
+        with self._lock:
+            self._users.pop(user_id, None)
+            self._active.discard(user_id)
+            self._departed.add(user_id)
+
+    def _expire(self, now):
+        # Callers hold the lock; drops users and room stamps older than the TTL
+        cutoff = now - self.ttl
+        for user_id in [user_id for user_id, entry in self._users.items() if entry['last_seen'] < cutoff]:
+            del self._users[user_id]
+        for entry in self._users.values():
+            for room_id in [room_id for room_id, seen in entry['rooms'].items() if seen < cutoff]:
+                del entry['rooms'][room_id]
+
+    def is_online(self, user_id):
+        """Whether the user has sent a heartbeat within the TTL"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._users.get(user_id)
+            return entry is not None and entry['last_seen'] >= now - self.ttl
+
+    def online_user_ids(self):
+        """Ids of every user currently online"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            return set(self._users)
+
+    def room_online(self, room_id):
+        """Usernames active in a room within the TTL, sorted"""
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            return sorted(entry['username'] for entry in self._users.values()
+                          if entry['rooms'].get(room_id, 0) >= cutoff)
+
+    def flush(self):
+        """Persist presence with bulk UPDATEs that are safe across workers
+
+        Each worker only stamps ``last_seen`` on users active in it since the
+        last flush; nobody is marked offline because one worker stopped
+        seeing them. Users go offline once no worker has stamped them for
+        PRESENCE_TTL, or right away on logout.
+        """
+        from app import db
+        from models import User
+
+        with self._lock:
+            self._expire(time.monotonic())
+            active, self._active = self._active, set()
+            departed, self._departed = self._departed, set()
+        now = datetime.utcnow()
+
+        with self.app.app_context():
+            try:
+                if active:
+                    db.session.execute(db.update(User).where(User.id.in_(active)).values(is_online=True, last_seen=now))
+                if departed:
+                    db.session.execute(db.update(User).where(User.id.in_(departed)).values(is_online=False))
+                db.session.execute(
+                    db.update(User)
+                    .where(User.is_online.is_(True),
+                           db.or_(User.last_seen.is_(None), User.last_seen < now - timedelta(seconds=self.ttl)))
+                    .values(is_online=False)
+                )
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Failed to persist presence: {e}")
+            finally:
+                db.session.remove()
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        """Persist the final state and stop the flusher thread"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self.flush()
+
+# Global presence tracker instance
+presence_tracker = PresenceTracker()
+atexit.register(presence_tracker.stop)
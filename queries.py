@@ -0,0 +1,116 @@
+from sqlalchemy.orm import joinedload
+from app import db
+from models import Room, RoomMember, Message
+
+class RoomNotFound(LookupError):
+    """Raised when messages are inserted into a room that no longer exists"""
+    pass
+
+def get_user_rooms(user_id):
+    """Get all rooms a user belongs to in a single query, in join order"""
+    return (Room.query
+            .join(RoomMember, RoomMember.room_id == Room.id)
+            .filter(RoomMember.user_id == user_id)
+            .order_by(RoomMember.id)
+            .all())
+
+def count_room_members(room_id):
+    """Count members of a room without loading them"""
+    return db.session.query(db.func.count(RoomMember.id)).filter(RoomMember.room_id == room_id).scalar()
+
+def _messages_with_senders(room_id):
+    return Message.query.options(joinedload(Message.sender)).filter(Message.room_id == room_id)
+
+def get_message_page(room_id, before_id=None, limit=50):
+    """Get a page of history ending just before ``before_id`` (or at the newest message)
+
+    Uses keyset pagination on the ``(room_id, id)`` index, so the cost does not
+    depend on how deep into the history the page is. Returns
+    ``(messages, has_more)`` with messages oldest first.
+    """
+    query = _messages_with_senders(room_id)
+    if before_id is not None:
+        query = query.filter(Message.id < before_id)
+    messages = query.order_by(Message.id.desc()).limit(limit + 1).all()
+    has_more = len(messages) > limit
+    return list(reversed(messages[:limit])), has_more
+
+def get_messages_since(room_id, since_id, limit=100):
+    """Get messages newer than ``since_id``, oldest first, with senders eager-loaded"""
+    return (_messages_with_senders(room_id)
+            .filter(Message.id > since_id)
+            .order_by(Message.id.asc())
+            .limit(limit)
+            .all())
+
+def get_messages_by_ids(message_ids):
+    """Load specific messages, newest first, with senders eager-loaded"""
+    if not message_ids:
+        return []
+    return (Message.query
+            .options(joinedload(Message.sender))
+            .filter(Message.id.in_(message_ids))
+            .order_by(Message.id.desc())
+            .all())
+
+def assign_room_seqs(rows):
+    """Advance Room.message_count for message rows about to be inserted and number them
+
+    One ``UPDATE ... RETURNING`` per room reserves a block of counter values
+    and sets each row's ``room_seq``, in row order. Runs inside the caller's
+    transaction before the INSERT; the room row stays locked until commit,
+    so concurrent writers to a room get ids in the same order as sequence
+    numbers. Raises RoomNotFound if a room is gone, e.g. deleted while
+    another worker's membership cache still listed it; the caller rolls back.
+    """
+    per_room = {}
+    for row in rows:
+        per_room.setdefault(row['room_id'], []).append(row)
+    for room_id, room_rows in per_room.items():
+        last_seq = db.session.scalar(
+            db.update(Room)
+            .where(Room.id == room_id)
+            .values(message_count=Room.message_count + len(room_rows))
+            .returning(Room.message_count)
+        )
+        if last_seq is None:
+            raise RoomNotFound(f"Room {room_id} does not exist")
+        for seq, row in enumerate(room_rows, start=last_seq - len(room_rows) + 1):
+            row['room_seq'] = seq
+
+def get_unread_counts(user_id):
+    """Return ``{room_id: unread}`` for every room the user belongs to in one query
+
+    Walks the ``(user_id, room_id)`` unique index on RoomMember and compares
+    each room's message counter with the count recorded at the read marker,
+    so no Message rows are touched.
+    """
+    rows = db.session.execute(
+        db.select(RoomMember.room_id, Room.message_count - RoomMember.read_count)
+        .join(Room, Room.id == RoomMember.room_id)
+        .where(RoomMember.user_id == user_id)
+    ).all()
+    return {room_id: max(unread, 0) for room_id, unread in rows}
+
+def mark_read(user_id, room_id, message_id):
+    """Move the user's read marker forward to ``message_id``; never moves it back
+
+    The unread baseline becomes that message's ``room_seq``, so messages
+    posted after it stay unread however late the marker is written. Messages
+    from before sequence numbers existed leave the baseline unchanged.
+    Returns True if the marker moved. The caller commits.
+    """
+    in_room = (Message.id == message_id, Message.room_id == room_id)
+    message_seq = db.select(Message.room_seq).where(*in_room).scalar_subquery()
+    result = db.session.execute(
+        db.update(RoomMember)
+        .where(RoomMember.user_id == user_id, RoomMember.room_id == room_id,
+               db.or_(RoomMember.last_read_message_id.is_(None), RoomMember.last_read_message_id < message_id),
+               db.select(Message.id).where(*in_room).exists())
+        .values(last_read_message_id=message_id, read_count=db.func.coalesce(message_seq, RoomMember.read_count))
+    )
+    return result.rowcount > 0
+
+def get_latest_message_id(room_id):
+    """Return the id of the newest message in a room, or 0 if it is empty"""
+    return db.session.query(db.func.max(Message.id)).filter(Message.room_id == room_id).scalar() or 0
@@ -0,0 +1,90 @@
+import queue
+import asyncio
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+class AsyncSubscriber:
+    def __init__(self, room_id, max_queue_size):
+        """Initialize a subscriber that delivers into an asyncio queue on the running loop"""
+        self.room_id = room_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+
+    def put_nowait(self, event):
+        # publish() runs on request and ingest threads; hand over to the loop
+        try:
+            self.loop.call_soon_threadsafe(self._deliver, event)
+        except RuntimeError:
+            pass  # Loop already closed; the connection is gone
+
+    def _deliver(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            logger.warning(f"Dropping event for slow subscriber in room {self.room_id}")
+
+    async def get(self):
+        """Wait for the next event"""
+        return await self.queue.get()
+
+class MessageHub:
+    def __init__(self, max_queue_size=100):
+        """Initialize an in-process publish/subscribe hub keyed by room id"""
+        self.max_queue_size = max_queue_size
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, room_id):
+        """Register a new subscriber for a room and return its event queue"""
+        subscriber = queue.Queue(maxsize=self.max_queue_size)
+        with self._lock:
+            self._subscribers.setdefault(room_id, set()).add(subscriber)
+        logger.debug(f"Subscriber added to room {room_id}")
+        return subscriber
+
+    def subscribe_async(self, room_id):
+        """Register a subscriber for a coroutine; must be called on the event loop"""
+        subscriber = AsyncSubscriber(room_id, self.max_queue_size)
+        with self._lock:
+            self._subscribers.setdefault(room_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, room_id, subscriber):
+        """Remove a subscriber, dropping the room entry once it is empty"""
+        with self._lock:
+            room_subscribers = self._subscribers.get(room_id)
+            if room_subscribers is None:
+                return
+            room_subscribers.discard(subscriber)
+            if not room_subscribers:
+                del self._subscribers[room_id]
+
+    def publish(self, room_id, event):
+        """Deliver an event to every subscriber of a room without blocking
+
+        Subscribers whose queue is full are skipped; they catch up from the
+        database when they reconnect with their last seen message id.
+        """
+        with self._lock:
+            room_subscribers = list(self._subscribers.get(room_id, ()))
+
+        delivered = 0
+        for subscriber in room_subscribers:
+            try:
+                subscriber.put_nowait(event)
+                delivered += 1
+            except queue.Full:
+                logger.warning(f"Dropping event for slow subscriber in room {room_id}")
+        return delivered
+
+    def subscriber_count(self, room_id=None):
+        """Number of subscribers for one room, or across all rooms"""
+        with self._lock:
+            if room_id is not None:
+                return len(self._subscribers.get(room_id, ()))
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+# Global message hub instance
+message_hub = MessageHub()
@@ -0,0 +1,155 @@
+import threading
+import time
+import atexit
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+class RetentionEngine:
+    def __init__(self, interval=3600, batch_size=1000, pause=0.0):
+        """Initialize the background job enforcing per-room retention policies"""
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.app = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def init_app(self, app):
+        """Bind the engine to an app; an interval of 0 disables the background job"""
+        self.app = app
+        self.interval = app.config.get('RETENTION_INTERVAL', self.interval)
+        self.batch_size = app.config.get('RETENTION_BATCH_SIZE', self.batch_size)
+        self.pause = app.config.get('RETENTION_BATCH_PAUSE', self.pause)
+        if self.interval > 0:
+            app.before_request(self._ensure_started)
+
+    def _ensure_started(self):
+        # Started lazily so each gunicorn worker gets its own thread after fork
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+                self._thread.start()
+
+    def _delete_batches(self, room_id, condition):
+        """Delete a room's messages matching condition in bounded, id-ordered batches
+
+        Each batch selects at most batch_size ids through the (room_id, ...)
+        indexes, removes their search tokens and then the messages, and
+        commits, so locks are held briefly and memory stays flat.
+        """
+        from app import db
+        from models import Message, SearchToken
+        from fragments import fragment_cache
+
+        deleted = 0
+        while not self._stopping.is_set():
+            ids = db.session.scalars(
+                db.select(Message.id)
+                .where(Message.room_id == room_id, condition)
+                .order_by(Message.id)
+                .limit(self.batch_size)
+            ).all()
+            if not ids:
+                break
+            db.session.execute(db.delete(SearchToken).where(SearchToken.message_id.in_(ids)))
+            db.session.execute(db.delete(Message).where(Message.id.in_(ids)))
+            db.session.commit()
+            fragment_cache.invalidate(room_id)
+            deleted += len(ids)
+            if self.pause:
+                time.sleep(self.pause)
+        return deleted
+
+    def enforce_room(self, room):
+        """Apply one room's max age and max count policies; returns messages deleted"""
+        from app import db
+        from models import Message
+
+        deleted = 0
+        if room.retention_days:
+            cutoff = datetime.utcnow() - timedelta(days=room.retention_days)
+            deleted += self._delete_batches(room.id, Message.timestamp < cutoff)
+
+        if room.retention_max_messages:
+            # Newest id that falls outside the kept window, found by walking ix_message_room_id_id
+            boundary = db.session.scalar(
+                db.select(Message.id)
+                .where(Message.room_id == room.id)
+                .order_by(Message.id.desc())
+                .offset(room.retention_max_messages)
+                .limit(1)
+            )
+            if boundary is not None:
+                deleted += self._delete_batches(room.id, Message.id <= boundary)
+
+        if deleted:
+            logger.info(f"Retention removed {deleted} messages from room {room.id}")
+        return deleted
+
+    def enforce(self):
+        """Apply every room's retention policy; returns the total messages deleted"""
+        from app import db
+        from models import Room
+
+        rooms = db.session.execute(
+            db.select(Room.id, Room.retention_days, Room.retention_max_messages)
+            .where(db.or_(Room.retention_days.is_not(None), Room.retention_max_messages.is_not(None)))
+        ).all()
+        return sum(self.enforce_room(room) for room in rooms)
+
+    def delete_room(self, room_id):
+        """Delete a room and everything in it with bulk statements
+
+        Nothing is loaded into the ORM: messages go in bounded batches, then
+        memberships and the room row. Returns the number of messages deleted.
+        Only this process's caches are invalidated; other workers drop the
+        room when their cache entries expire, and refuse new messages to it
+        in the meantime (see queries.assign_room_seqs).
+        """
+        from app import db
+        from models import Message, Room, RoomMember, SearchToken
+        from membership import membership_cache
+
+        member_ids = db.session.scalars(db.select(RoomMember.user_id).where(RoomMember.room_id == room_id)).all()
+        deleted = self._delete_batches(room_id, db.true())
+        # Workers with a cached membership may still have posted since the last
+        # batch; sweep those rows in the same transaction as the room itself
+        room_messages = db.select(Message.id).where(Message.room_id == room_id)
+        db.session.execute(db.delete(SearchToken).where(SearchToken.message_id.in_(room_messages)))
+        deleted += db.session.execute(db.delete(Message).where(Message.room_id == room_id)).rowcount
+        db.session.execute(db.delete(RoomMember).where(RoomMember.room_id == room_id))
+        db.session.execute(db.delete(Room).where(Room.id == room_id))
+        db.session.commit()
+
+        for user_id in member_ids:
+            membership_cache.invalidate(user_id)
+        logger.info(f"Deleted room {room_id} with {deleted} messages")
+        return deleted
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    self.enforce()
+                except Exception as e:
+                    logger.error(f"Retention run failed: {e}")
+                finally:
+                    from app import db
+                    db.session.rollback()
+                    db.session.remove()
+
+    def stop(self):
+        """Stop the background job after its current batch"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(5)
+
+# Global retention engine instance
+retention_engine = RetentionEngine()
+atexit.register(retention_engine.stop)
@@ -1,15 +1,171 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session
+from markupsafe import Markup
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session, make_response, Response, stream_with_context, current_app, abort
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash
+from sqlalchemy.exc import IntegrityError
 from models import User, Room, Message, RoomMember
 from app import db
-from crypto_utils import crypto_manager, CryptoError
+from crypto_utils import crypto_manager, CryptoError, room_key_id
+from realtime import message_hub
+from ingest import message_ingestor, IngestQueueFull, ACK_COMMITTED
+from presence import presence_tracker
+from search import index_rows, search_message_ids
+from membership import membership_cache
+from fragments import fragment_cache
+import queries
+from datetime import datetime
+import json
+import queue
+import time
+import uuid
 import logging
 
 logger = logging.getLogger(__name__)
 
 main = Blueprint('main', __name__)
 
+# Upper bound on messages returned by a single incremental sync
+SYNC_BATCH_LIMIT = 100
+
+# Messages per page of room history
+HISTORY_PAGE_SIZE = 50
+
+# Longest message accepted, matching the maxlength of the chat input
+MAX_MESSAGE_LENGTH = 1000
+
+# Columns send_message fills in when inserting a Message
+MESSAGE_COLUMNS = ('content_encrypted', 'key_id', 'sender_id', 'room_id', 'message_id', 'timestamp', 'room_seq')
+
+def announce_messages(rows):
+    """Cache plaintext and push newly committed messages to stream clients
+
+    ``rows`` are the dicts built by send_message, with ``id`` filled in after
+    the insert. Also used as the batched ingestor's post-commit hook.
+    """
+    for room_id in {row['room_id'] for row in rows}:
+        fragment_cache.invalidate(room_id)
+    
+    for row in rows:
+        # Readers will want this message next; skip their first decrypt
+        crypto_manager.plaintext_cache.put(row['message_id'], row['content'])
+        
+        # Push to connected stream clients; plaintext is already in hand
+        message_hub.publish(row['room_id'], {
+            'id': row['id'],
+            'message_id': row['message_id'],
+            'content': row['content'],
+            'sender': row['sender'],
+            'sender_id': row['sender_id'],
+            'timestamp': row['timestamp'].isoformat()
+        })
+
+def record_inserted(rows):
+    """Index freshly inserted messages inside their transaction
+
+    Also used as the batched ingestor's insert hook.
+    """
+    index_rows(rows)
+
+def _queue_message(row):
+    """Hand a message to the batched ingestor, honouring the configured ack policy
+
+    Returns False if the queue is full so the caller can insert directly. If
+    the commit is not confirmed within MESSAGE_INGEST_ACK_TIMEOUT the message
+    is still queued, so it is acknowledged as queued rather than failed; a
+    client retrying it under a new message_id would create a duplicate.
+    """
+    try:
+        future = message_ingestor.submit(row)
+    except IngestQueueFull:
+        logger.warning("Ingestion queue full, inserting message directly")
+        return False
+    
+    if current_app.config['MESSAGE_INGEST_ACK'] == ACK_COMMITTED:
+        try:
+            future.result(timeout=current_app.config['MESSAGE_INGEST_ACK_TIMEOUT'])
+        except TimeoutError:
+            logger.warning(f"Commit of message {row['message_id']} not confirmed in time, acknowledging as queued")
+    return True
+
+def _create_message(room, content, message_id=None):
+    """Encrypt and store a message from the current user, then announce it
+
+    ``room`` is the membership cache entry for the target room. Returns the
+    message row; ``id`` is missing when batched ingestion acked it as queued.
+    """
+    # Encrypt message under the room's current key
+    key_id = room_key_id(room['id'], room['key_version'])
+    encrypted_content = crypto_manager.encrypt_message(content, key_id=key_id)
+    
+    presence_tracker.heartbeat(current_user.id, current_user.username, room['id'])
+    
+    row = {
+        'content_encrypted': encrypted_content,
+        'key_id': key_id,
+        'sender_id': current_user.id,
+        'room_id': room['id'],
+        'message_id': message_id or str(uuid.uuid4()),
+        'timestamp': datetime.utcnow(),
+        'content': content,
+        'sender': current_user.username
+    }
+    
+    if not (current_app.config['MESSAGE_INGEST_MODE'] == 'batched' and _queue_message(row)):
+        queries.assign_room_seqs([row])
+        message = Message(**{key: row[key] for key in MESSAGE_COLUMNS})
+        db.session.add(message)
+        db.session.flush()
+        row['id'] = message.id
+        record_inserted([row])
+        db.session.commit()
+        announce_messages([row])
+    
+    return row
+
+def _render_message_list(room_id, before=None):
+    """Render a room's message list for the current user; returns ``(html, newest_id)``
+
+    The newest page is served from the fragment cache while the room's newest
+    message id is unchanged, so repeat views skip loading, decrypting and
+    rendering. Only the per-viewer overlay runs on every request.
+    """
+    if before is None:
+        latest_id = queries.get_latest_message_id(room_id)
+        entry = fragment_cache.get(room_id, latest_id)
+        if entry is None:
+            raw_messages, has_more = queries.get_message_page(room_id, limit=HISTORY_PAGE_SIZE)
+            html = render_template('message_list.html', messages=_messages_to_dicts(raw_messages), has_more=has_more)
+            fragment_cache.set(room_id, latest_id, html, has_more)
+        else:
+            html = entry['html']
+    else:
+        raw_messages, has_more = queries.get_message_page(room_id, before_id=before, limit=HISTORY_PAGE_SIZE)
+        html = render_template('message_list.html', messages=_messages_to_dicts(raw_messages), has_more=has_more)
+        latest_id = raw_messages[-1].id if raw_messages else 0
+    
+    return Markup(fragment_cache.overlay(html, current_user.id)), latest_id
+
+def _messages_to_dicts(raw_messages):
+    """Decrypt messages in one batch and build the dicts used by templates and the JSON API"""
+    results = crypto_manager.decrypt_many(
+        [msg.content_encrypted for msg in raw_messages],
+        cache_keys=[msg.message_id for msg in raw_messages],
+        key_ids=[msg.key_id for msg in raw_messages]
+    )
+    
+    messages = []
+    for msg, result in zip(raw_messages, results):
+        messages.append({
+            'id': msg.id,
+            'message_id': msg.message_id,
+            'content': result.value if result.ok else '[Message could not be decrypted]',
+            'sender': msg.sender.username,
+            'sender_id': msg.sender_id,
+            'timestamp': msg.timestamp,
+            'is_own': msg.sender_id == current_user.id
+        })
+    return messages
+
 @main.route('/')
 def index():
     """Home page - redirect to login if not authenticated, otherwise show chat rooms"""
@@ -73,6 +229,7 @@ def register():
             # Add user to general room
             general_room.add_member(user)
             db.session.commit()
+            membership_cache.invalidate(user.id)
             
             flash('Registration successful! Please log in.', 'success')
             return redirect(url_for('main.login'))
@@ -104,8 +261,7 @@ def login():
         
         if user and user.check_password(password):
             login_user(user, remember=remember_me)
-            user.is_online = True
-            db.session.commit()
+            presence_tracker.heartbeat(user.id, user.username)
             
             next_page = request.args.get('next')
             if next_page:
@@ -120,8 +276,7 @@ def login():
 @login_required
 def logout():
     """User logout"""
-    current_user.is_online = False
-    db.session.commit()
+    presence_tracker.disconnect(current_user.id)
     logout_user()
     flash('You have been logged out.', 'info')
     return redirect(url_for('main.index'))
@@ -132,7 +287,7 @@ def logout():
 def chat(room_id=None):
     """Main chat interface"""
     # Get user's rooms
-    user_rooms = current_user.get_rooms()
+    user_rooms = membership_cache.get_user_rooms(current_user.id)
     
     if not user_rooms:
         flash('You are not a member of any rooms.', 'info')
@@ -140,42 +295,37 @@ def chat(room_id=None):
     
     # Select room
     if room_id:
-        current_room = Room.query.get_or_404(room_id)
-        if not current_room.is_member(current_user):
+        if not membership_cache.is_member(room_id, current_user.id):
             flash('You are not a member of this room.', 'error')
             return redirect(url_for('main.chat'))
     else:
-        current_room = user_rooms[0]  # Default to first room
+        room_id = user_rooms[0]['id']  # Default to first room
+    
+    current_room = db.session.get(Room, room_id)
+    if current_room is None:
+        abort(404)
+    presence_tracker.heartbeat(current_user.id, current_user.username, room_id)
     
     # Get room messages
     try:
-        messages = []
-        raw_messages = current_room.messages.order_by(Message.timestamp.asc()).limit(50).all()
-        
-        for msg in raw_messages:
-            try:
-                decrypted_content = crypto_manager.decrypt_message(msg.content_encrypted)
-                messages.append({
-                    'id': msg.id,
-                    'content': decrypted_content,
-                    'sender': msg.sender.username,
-                    'timestamp': msg.timestamp,
-                    'is_own': msg.sender_id == current_user.id
-                })
-            except CryptoError as e:
-                logger.error(f"Failed to decrypt message {msg.id}: {e}")
-                messages.append({
-                    'id': msg.id,
-                    'content': '[Message could not be decrypted]',
-                    'sender': msg.sender.username,
-                    'timestamp': msg.timestamp,
-                    'is_own': msg.sender_id == current_user.id
-                })
+        before = request.args.get('before', type=int)
+        message_list, latest_id = _render_message_list(current_room.id, before)
+        
+        # Viewing the newest page reads the room; only write when something was unread
+        unread = queries.get_unread_counts(current_user.id)
+        if before is None and latest_id and unread.get(current_room.id):
+            queries.mark_read(current_user.id, current_room.id, latest_id)
+            db.session.commit()
+            unread[current_room.id] = 0
         
         return render_template('chat.html', 
                              rooms=user_rooms, 
+                             unread=unread, 
                              current_room=current_room, 
-                             messages=messages)
+                             member_count=queries.count_room_members(current_room.id),
+                             online_users=presence_tracker.room_online(current_room.id),
+                             message_list=message_list,
+                             stream_enabled=current_app.config['STREAM_ENABLED'])
                              
     except Exception as e:
         logger.error(f"Error loading chat: {e}")
@@ -187,36 +337,29 @@ def chat(room_id=None):
 def send_message():
     """Send a new message"""
     try:
-        room_id = request.form.get('room_id')
+        room_id = request.form.get('room_id', type=int)
         message_content = request.form.get('message', '').strip()
         
         if not room_id or not message_content:
             flash('Room and message content are required.', 'error')
             return redirect(url_for('main.chat'))
         
-        room = Room.query.get_or_404(room_id)
-        
         # Check if user is member of room
-        if not room.is_member(current_user):
+        room = membership_cache.get_room(room_id, current_user.id)
+        if room is None:
             flash('You are not a member of this room.', 'error')
             return redirect(url_for('main.chat'))
         
-        # Encrypt message
-        encrypted_content = crypto_manager.encrypt_message(message_content)
-        
-        # Create message
-        message = Message(
-            content_encrypted=encrypted_content,
-            sender_id=current_user.id,
-            room_id=room.id
-        )
-        
-        db.session.add(message)
-        db.session.commit()
+        _create_message(room, message_content)
         
-        logger.info(f"Message sent by {current_user.username} to room {room.name}")
-        return redirect(url_for('main.chat', room_id=room.id))
+        logger.info(f"Message sent by {current_user.username} to room {room_id}")
+        return redirect(url_for('main.chat', room_id=room_id))
         
+    except queries.RoomNotFound:
+        db.session.rollback()
+        membership_cache.invalidate(current_user.id)
+        flash('This room no longer exists.', 'error')
+        return redirect(url_for('main.chat'))
     except CryptoError as e:
         logger.error(f"Encryption error: {e}")
         flash('Failed to encrypt message. Please try again.', 'error')
@@ -262,6 +405,7 @@ def create_room():
         # Add creator as member
         room.add_member(current_user)
         db.session.commit()
+        membership_cache.invalidate(current_user.id)
         
         flash(f'Room "{room_name}" created successfully!', 'success')
         return redirect(url_for('main.chat', room_id=room.id))
@@ -288,13 +432,14 @@ def join_room():
             flash('Room not found.', 'error')
             return redirect(url_for('main.chat'))
         
-        if room.is_member(current_user):
+        if membership_cache.is_member(room.id, current_user.id):
             flash('You are already a member of this room.', 'info')
             return redirect(url_for('main.chat', room_id=room.id))
         
         # Add user to room
         room.add_member(current_user)
         db.session.commit()
+        membership_cache.invalidate(current_user.id)
         
         flash(f'Successfully joined room "{room_name}"!', 'success')
         return redirect(url_for('main.chat', room_id=room.id))
@@ -308,39 +453,273 @@ def join_room():
 @main.route('/api/messages/<int:room_id>')
 @login_required
 def get_messages(room_id):
-    """API endpoint to get recent messages for a room"""
+    """API endpoint to get recent messages for a room
+
+    Clients pass the id of the newest message they already have as ``since``
+    (or ``after``) and only receive messages posted after it. The response
+    carries an ETag derived from the newest message in the room, so a poll
+    that finds nothing new is answered with 304 before anything is loaded or
+    decrypted. Passing ``before`` instead returns the page of older history
+    preceding that message id.
+    """
     try:
-        room = Room.query.get_or_404(room_id)
-        
-        if not room.is_member(current_user):
+        if not membership_cache.is_member(room_id, current_user.id):
             return jsonify({'error': 'Access denied'}), 403
-        
-        # Get recent messages
-        messages = []
-        raw_messages = room.messages.order_by(Message.timestamp.desc()).limit(20).all()
-        
-        for msg in reversed(raw_messages):
-            try:
-                decrypted_content = crypto_manager.decrypt_message(msg.content_encrypted)
-                messages.append({
-                    'id': msg.id,
-                    'content': decrypted_content,
-                    'sender': msg.sender.username,
-                    'timestamp': msg.timestamp.isoformat(),
-                    'is_own': msg.sender_id == current_user.id
-                })
-            except CryptoError as e:
-                logger.error(f"Failed to decrypt message {msg.id}: {e}")
-                messages.append({
-                    'id': msg.id,
-                    'content': '[Message could not be decrypted]',
-                    'sender': msg.sender.username,
-                    'timestamp': msg.timestamp.isoformat(),
-                    'is_own': msg.sender_id == current_user.id
-                })
-        
-        return jsonify({'messages': messages})
+        presence_tracker.heartbeat(current_user.id, current_user.username, room_id)
+        
+        since = request.args.get('since', type=int)
+        if since is None:
+            since = request.args.get('after', type=int)
+        before = request.args.get('before', type=int)
+        
+        # Older history pages never change, so they skip the ETag check
+        if before is not None:
+            raw_messages, has_more = queries.get_message_page(room_id, before_id=before, limit=HISTORY_PAGE_SIZE)
+            messages = _messages_to_dicts(raw_messages)
+            for message in messages:
+                message['timestamp'] = message['timestamp'].isoformat()
+            return jsonify({'messages': messages, 'has_more': has_more})
+        
+        # Cheap conditional check against the newest message id in the room
+        latest_id = queries.get_latest_message_id(room_id)
+        etag = f'{room_id}-{latest_id}'
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+            response.set_etag(etag)
+            return response
+        
+        # Get new messages since the cursor, or the most recent ones
+        has_more = None
+        if since is not None:
+            raw_messages = queries.get_messages_since(room_id, since, limit=SYNC_BATCH_LIMIT)
+        else:
+            raw_messages, has_more = queries.get_message_page(room_id, limit=HISTORY_PAGE_SIZE)
+        
+        messages = _messages_to_dicts(raw_messages)
+        for message in messages:
+            message['timestamp'] = message['timestamp'].isoformat()
+        
+        cursor = raw_messages[-1].id if raw_messages else since
+        if since is not None and len(raw_messages) == SYNC_BATCH_LIMIT:
+            # A truncated batch only reaches its cursor; tagging it with the
+            # newest id would turn the follow-up poll into a 304
+            etag = f'{room_id}-{cursor}'
+        payload = {'messages': messages, 'cursor': cursor}
+        if has_more is not None:
+            payload['has_more'] = has_more
+        response = jsonify(payload)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
         
     except Exception as e:
         logger.error(f"Error getting messages: {e}")
         return jsonify({'error': 'Failed to load messages'}), 500
+
+@main.route('/api/messages/<int:room_id>', methods=['POST'])
+@login_required
+def post_message(room_id):
+    """API endpoint to send a message and get the stored message back
+
+    Clients may supply their own ``message_id`` (a UUID) so an optimistically
+    rendered message can be matched with the stored one and with the copy
+    delivered by the stream. Returns 201 once the message is committed, or
+    202 without an ``id`` when batched ingestion acknowledges on queueing.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('content'), str):
+        return jsonify({'error': 'Message content is required'}), 400
+    content = data['content'].strip()
+    if not content:
+        return jsonify({'error': 'Message content is required'}), 400
+    if len(content) > MAX_MESSAGE_LENGTH:
+        return jsonify({'error': f'Message must be at most {MAX_MESSAGE_LENGTH} characters'}), 400
+    
+    message_id = data.get('message_id')
+    if message_id is not None:
+        try:
+            message_id = str(uuid.UUID(str(message_id)))
+        except ValueError:
+            return jsonify({'error': 'Invalid message_id'}), 400
+    
+    room = membership_cache.get_room(room_id, current_user.id)
+    if room is None:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    try:
+        row = _create_message(room, content, message_id=message_id)
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Duplicate message_id'}), 409
+    except queries.RoomNotFound:
+        # Deleted by another process while this worker's membership cache still had it
+        db.session.rollback()
+        membership_cache.invalidate(current_user.id)
+        return jsonify({'error': 'Room not found'}), 404
+    except CryptoError as e:
+        logger.error(f"Encryption error: {e}")
+        return jsonify({'error': 'Failed to encrypt message'}), 500
+    except Exception as e:
+        logger.error(f"Error sending message: {e}")
+        db.session.rollback()
+        return jsonify({'error': 'Failed to send message'}), 500
+    
+    message = {
+        'id': row.get('id'),
+        'message_id': row['message_id'],
+        'content': content,
+        'sender': row['sender'],
+        'sender_id': row['sender_id'],
+        'timestamp': row['timestamp'].isoformat(),
+        'is_own': True
+    }
+    return jsonify({'message': message}), 201 if message['id'] is not None else 202
+
+@main.route('/api/unread')
+@login_required
+def unread_counts():
+    """API endpoint with unread message counts for all of the user's rooms"""
+    return jsonify({'unread': queries.get_unread_counts(current_user.id)})
+
+@main.route('/api/rooms/<int:room_id>/read', methods=['POST'])
+@login_required
+def mark_room_read(room_id):
+    """API endpoint moving the user's read marker forward to ``message_id``"""
+    if not membership_cache.is_member(room_id, current_user.id):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    data = request.get_json(silent=True)
+    try:
+        message_id = int(data['message_id'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'message_id is required'}), 400
+    
+    queries.mark_read(current_user.id, room_id, message_id)
+    db.session.commit()
+    return '', 204
+
+@main.route('/api/rooms/<int:room_id>/presence')
+@login_required
+def room_presence(room_id):
+    """API endpoint listing who is online in a room, answered from memory"""
+    if not membership_cache.is_member(room_id, current_user.id):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    return jsonify({'online': presence_tracker.room_online(room_id)})
+
+@main.route('/api/rooms/<int:room_id>/search')
+@login_required
+def search_messages(room_id):
+    """API endpoint to search a room's history through the blind keyword index
+
+    Every word of ``q`` must appear in a message for it to match. Only the
+    matching messages are loaded and decrypted; ``before`` pages further back.
+    """
+    if not membership_cache.is_member(room_id, current_user.id):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    query = request.args.get('q', '').strip()
+    before = request.args.get('before', type=int)
+    if not query:
+        return jsonify({'error': 'Search query is required'}), 400
+    
+    try:
+        ids = search_message_ids(room_id, query, limit=HISTORY_PAGE_SIZE, before_id=before)
+        messages = _messages_to_dicts(queries.get_messages_by_ids(ids))
+        for message in messages:
+            message['timestamp'] = message['timestamp'].isoformat()
+        return jsonify({'messages': messages, 'has_more': len(ids) == HISTORY_PAGE_SIZE})
+        
+    except Exception as e:
+        logger.error(f"Error searching messages: {e}")
+        return jsonify({'error': 'Search failed'}), 500
+
+def _replay_events(room_id, since):
+    """Yield every message after ``since`` as hub-style events, batch by batch
+    
+    Replay keeps fetching until it catches up with the room, so a reconnect
+    after a long gap never skips ahead to the first live event.
+    """
+    while True:
+        missed = queries.get_messages_since(room_id, since, limit=SYNC_BATCH_LIMIT)
+        for event in _messages_to_dicts(missed):
+            event['timestamp'] = event['timestamp'].isoformat()
+            yield event
+        if len(missed) < SYNC_BATCH_LIMIT:
+            return
+        since = missed[-1].id
+
+def _format_sse(event, user_id):
+    """Serialize a hub event as a Server-Sent Events frame for one viewer"""
+    payload = {key: value for key, value in event.items() if key not in ('sender_id', 'is_own')}
+    payload['is_own'] = event['sender_id'] == user_id
+    return f"id: {event['id']}\ndata: {json.dumps(payload)}\n\n"
+
+@main.route('/stream/<int:room_id>')
+@login_required
+def stream_messages(room_id):
+    """Server-Sent Events stream of new messages for a room
+
+    Messages missed since ``Last-Event-ID`` (or ``?since=``) are replayed
+    from the database before live events from the hub are forwarded. The
+    hub only carries messages sent through this process, so each keepalive
+    tick also checks the room's newest id and replays anything newer that
+    arrived through another worker. The stream closes after
+    STREAM_MAX_DURATION seconds and the browser reconnects, resuming from
+    the last event id it received. Returns 404 unless STREAM_ENABLED is set.
+    """
+    if not current_app.config['STREAM_ENABLED']:
+        abort(404)
+    if not membership_cache.is_member(room_id, current_user.id):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    user_id = current_user.id
+    username = current_user.username
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    keepalive = current_app.config['STREAM_KEEPALIVE_SECONDS']
+    max_duration = current_app.config['STREAM_MAX_DURATION']
+    
+    # Subscribe before the replay query so nothing slips in between
+    subscriber = message_hub.subscribe(room_id)
+    
+    def generate():
+        last_id = since or 0
+        presence_tracker.heartbeat(user_id, username, room_id)
+        try:
+            yield f"retry: {keepalive * 1000}\n\n"
+            
+            if since is not None:
+                for event in _replay_events(room_id, since):
+                    last_id = event['id']
+                    yield _format_sse(event, user_id)
+            
+            # Release the DB connection while idling on the hub
+            db.session.remove()
+            
+            deadline = time.monotonic() + max_duration
+            while time.monotonic() < deadline:
+                try:
+                    event = subscriber.get(timeout=keepalive)
+                except queue.Empty:
+                    # An open stream keeps its user present in the room
+                    presence_tracker.heartbeat(user_id, username, room_id)
+                    if queries.get_latest_message_id(room_id) > last_id:
+                        for event in _replay_events(room_id, last_id):
+                            last_id = event['id']
+                            yield _format_sse(event, user_id)
+                    db.session.remove()
+                    yield ": keepalive\n\n"
+                    continue
+                if event['id'] <= last_id:
+                    continue
+                last_id = event['id']
+                yield _format_sse(event, user_id)
+        finally:
+            message_hub.unsubscribe(room_id, subscriber)
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,59 @@
+import re
+from app import db
+from models import SearchToken
+from crypto_utils import crypto_manager
+
+WORD_RE = re.compile(r"\w+")
+
+# Words shorter than this are not indexed or searched
+MIN_WORD_LENGTH = 2
+
+# Upper bound on distinct words indexed per message
+MAX_WORDS_PER_MESSAGE = 200
+
+def tokenize(text):
+    """Split text into distinct, case-folded words in first-seen order"""
+    words = []
+    seen = set()
+    for match in WORD_RE.finditer(text.casefold()):
+        word = match.group()
+        if len(word) < MIN_WORD_LENGTH or word in seen:
+            continue
+        seen.add(word)
+        words.append(word)
+        if len(words) >= MAX_WORDS_PER_MESSAGE:
+            break
+    return words
+
+def index_rows(rows):
+    """Add blind index tokens for freshly inserted messages
+
+    ``rows`` need ``id``, ``room_id`` and plaintext ``content``. Runs inside
+    the caller's transaction, which is responsible for committing.
+    """
+    token_rows = []
+    for row in rows:
+        for token in crypto_manager.blind_tokens(row['room_id'], tokenize(row['content'])):
+            token_rows.append({'room_id': row['room_id'], 'message_id': row['id'], 'token': token})
+    if token_rows:
+        db.session.execute(db.insert(SearchToken), token_rows)
+
+def search_message_ids(room_id, query, limit=50, before_id=None):
+    """Ids of messages in a room containing every word of the query, newest first
+
+    Matching happens entirely on indexed tokens in SQL; nothing is decrypted.
+    """
+    words = tokenize(query)
+    if not words:
+        return []
+
+    tokens = [token for word in words for token in crypto_manager.blind_query_tokens(room_id, word)]
+    statement = (db.select(SearchToken.message_id)
+                 .where(SearchToken.room_id == room_id, SearchToken.token.in_(tokens))
+                 .group_by(SearchToken.message_id)
+                 .having(db.func.count(db.distinct(SearchToken.token)) == len(words))
+                 .order_by(SearchToken.message_id.desc())
+                 .limit(limit))
+    if before_id is not None:
+        statement = statement.where(SearchToken.message_id < before_id)
+    return db.session.scalars(statement).all()
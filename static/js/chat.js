@@ -9,6 +9,13 @@ class ChatManager {
         this.messageContainer = null;
         this.messageInput = null;
         this.isRefreshing = false;
+        this.lastMessageId = null;
+        this.etag = null;
+        this.eventSource = null;
+        this.streamConnected = false;
+        this.isLoadingOlder = false;
+        this.readMarker = null;
+        this.readTimer = null;
         
         this.init();
     }
@@ -24,11 +31,24 @@ class ChatManager {
             this.currentRoom = roomInput.value;
         }
         
+        // Resume syncing after the newest server-rendered message
+        if (this.messageContainer) {
+            const rendered = this.messageContainer.querySelectorAll('[data-message-id]');
+            if (rendered.length > 0) {
+                this.lastMessageId = parseInt(rendered[rendered.length - 1].dataset.messageId, 10);
+            }
+        }
+        
         // Bind events
         this.bindEvents();
         
-        // Start auto-refresh
+        // Push delivery only where the server can hold streams cheaply; polling
+        // is the default and stays on as a fallback
+        if (this.messageContainer && this.messageContainer.dataset.streamEnabled === 'true') {
+            this.startStream();
+        }
         this.startAutoRefresh();
+        this.startUnreadRefresh();
         
         console.log('ChatManager initialized for room:', this.currentRoom);
     }
@@ -47,11 +67,40 @@ class ChatManager {
             this.messageInput.addEventListener('keydown', (e) => {
                 if (e.key === 'Enter' && !e.shiftKey) {
                     e.preventDefault();
-                    messageForm.submit();
+                    // requestSubmit fires the submit handler; submit() would bypass it
+                    if (messageForm.requestSubmit) {
+                        messageForm.requestSubmit();
+                    } else {
+                        messageForm.submit();
+                    }
                 }
             });
         }
         
+        // Load older history
+        const loadOlderBtn = document.getElementById('loadOlderBtn');
+        if (loadOlderBtn) {
+            loadOlderBtn.addEventListener('click', (e) => {
+                e.preventDefault();
+                this.loadOlderMessages();
+            });
+        }
+        
+        // Search
+        const searchForm = document.getElementById('searchForm');
+        if (searchForm) {
+            searchForm.addEventListener('submit', (e) => {
+                e.preventDefault();
+                this.searchMessages(document.getElementById('searchInput').value.trim());
+            });
+        }
+        const searchClose = document.getElementById('searchClose');
+        if (searchClose) {
+            searchClose.addEventListener('click', () => {
+                document.getElementById('searchResults').classList.add('d-none');
+            });
+        }
+        
         // Refresh button
         const refreshBtn = document.querySelector('[onclick="refreshMessages()"]');
         if (refreshBtn) {
@@ -65,6 +114,9 @@ class ChatManager {
         document.addEventListener('visibilitychange', () => {
             if (!document.hidden) {
                 this.refreshMessages();
+                if (this.lastMessageId !== null) {
+                    this.markRead(this.lastMessageId);
+                }
             }
         });
     }
@@ -76,6 +128,14 @@ class ChatManager {
             return false;
         }
         
+        // Send over the JSON API when possible; otherwise let the form post
+        if (this.currentRoom && window.fetch && window.crypto && crypto.randomUUID) {
+            e.preventDefault();
+            this.messageInput.value = '';
+            this.sendMessage(message);
+            return false;
+        }
+        
         // Disable input during submission
         this.messageInput.disabled = true;
         
@@ -90,6 +150,136 @@ class ChatManager {
         return true;
     }
     
+    async sendMessage(content) {
+        const messageId = crypto.randomUUID();
+        const usernameEl = document.querySelector('.online-indicator + strong');
+        
+        // Show the message right away; it is reconciled by message_id
+        const element = this.addMessageElement({
+            message_id: messageId,
+            content: content,
+            sender: usernameEl ? usernameEl.textContent : '',
+            timestamp: new Date().toISOString(),
+            is_own: true
+        });
+        element.classList.add('message-pending');
+        
+        const emptyState = document.getElementById('emptyState');
+        if (emptyState) {
+            emptyState.remove();
+        }
+        this.scrollToBottom();
+        
+        try {
+            const response = await fetch(`/api/messages/${this.currentRoom}`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ content: content, message_id: messageId })
+            });
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            
+            const data = await response.json();
+            this.reconcileMessage(element, data.message);
+        } catch (error) {
+            console.error('Failed to send message:', error);
+            element.remove();
+            this.messageInput.value = content;
+            this.showError('Failed to send message');
+        }
+    }
+    
+    reconcileMessage(element, message) {
+        element.classList.remove('message-pending');
+        if (message.id !== null && message.id !== undefined) {
+            element.dataset.messageId = message.id;
+            this.markRead(message.id);
+        }
+    }
+    
+    markRead(messageId) {
+        // Coalesce bursts of incoming messages into one marker update
+        if (!this.currentRoom || document.hidden || (this.readMarker !== null && messageId <= this.readMarker)) {
+            return;
+        }
+        this.readMarker = messageId;
+        clearTimeout(this.readTimer);
+        this.readTimer = setTimeout(() => {
+            fetch(`/api/rooms/${this.currentRoom}/read`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ message_id: this.readMarker })
+            }).catch(error => console.error('Failed to update read marker:', error));
+        }, 1000);
+    }
+    
+    async refreshUnread() {
+        try {
+            const response = await fetch('/api/unread', { cache: 'no-store' });
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            
+            const data = await response.json();
+            document.querySelectorAll('[data-unread-room]').forEach(badge => {
+                const roomId = badge.dataset.unreadRoom;
+                const count = roomId === String(this.currentRoom) ? 0 : (data.unread[roomId] || 0);
+                badge.textContent = count > 99 ? '99+' : count;
+                badge.classList.toggle('d-none', count === 0);
+            });
+        } catch (error) {
+            console.error('Failed to refresh unread counts:', error);
+        }
+    }
+    
+    startUnreadRefresh() {
+        // Other rooms' counts come from a single cheap query every 30 seconds
+        setInterval(() => {
+            if (!document.hidden) {
+                this.refreshUnread();
+            }
+        }, 30000);
+    }
+    
+    async searchMessages(query) {
+        const panel = document.getElementById('searchResults');
+        const list = document.getElementById('searchResultsList');
+        if (!query || !panel || !list || !this.currentRoom) {
+            return;
+        }
+        
+        try {
+            const response = await fetch(`/api/rooms/${this.currentRoom}/search?q=${encodeURIComponent(query)}`);
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            
+            const data = await response.json();
+            list.innerHTML = '';
+            if (data.messages.length === 0) {
+                list.innerHTML = '<div class="text-muted small">No messages found.</div>';
+            }
+            data.messages.forEach(message => {
+                const item = document.createElement('div');
+                item.className = 'list-group-item';
+                const timeStr = new Date(message.timestamp).toLocaleString([], {dateStyle: 'short', timeStyle: 'short'});
+                item.innerHTML = `
+                    <div class="d-flex justify-content-between small text-muted">
+                        <span>${this.escapeHtml(message.sender)}</span>
+                        <span>${timeStr}</span>
+                    </div>
+                    <div>${this.escapeHtml(message.content)}</div>
+                `;
+                list.appendChild(item);
+            });
+            panel.classList.remove('d-none');
+        } catch (error) {
+            console.error('Failed to search messages:', error);
+            this.showError('Search failed');
+        }
+    }
+    
     async refreshMessages() {
         if (this.isRefreshing || !this.currentRoom) {
             return;
@@ -104,15 +294,32 @@ class ChatManager {
                 refreshIcon.style.animation = 'spin 1s linear infinite';
             }
             
-            // Fetch latest messages
-            const response = await fetch(`/api/messages/${this.currentRoom}`);
+            // Fetch only messages newer than the last one we have
+            let url = `/api/messages/${this.currentRoom}`;
+            if (this.lastMessageId !== null) {
+                url += `?since=${this.lastMessageId}`;
+            }
+            
+            const headers = {};
+            if (this.etag) {
+                headers['If-None-Match'] = this.etag;
+            }
+            
+            const response = await fetch(url, { headers, cache: 'no-store' });
+            if (response.status === 304) {
+                return;
+            }
             if (!response.ok) {
                 throw new Error(`HTTP ${response.status}`);
             }
             
+            this.etag = response.headers.get('ETag');
             const data = await response.json();
             if (data.messages) {
-                this.updateMessages(data.messages);
+                this.appendMessages(data.messages);
+            }
+            if (data.cursor !== null && data.cursor !== undefined) {
+                this.lastMessageId = data.cursor;
             }
             
         } catch (error) {
@@ -128,27 +335,80 @@ class ChatManager {
         }
     }
     
-    updateMessages(messages) {
+    async loadOlderMessages() {
+        if (this.isLoadingOlder || !this.currentRoom || !this.messageContainer) {
+            return;
+        }
+        
+        const first = this.messageContainer.querySelector('[data-message-id]');
+        if (!first) {
+            return;
+        }
+        
+        this.isLoadingOlder = true;
+        try {
+            const response = await fetch(`/api/messages/${this.currentRoom}?before=${first.dataset.messageId}`);
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            
+            const data = await response.json();
+            
+            // Keep the viewport anchored on the messages the user was reading
+            const previousHeight = this.messageContainer.scrollHeight;
+            data.messages.forEach(message => {
+                this.addMessageElement(message, first);
+            });
+            this.messageContainer.scrollTop += this.messageContainer.scrollHeight - previousHeight;
+            
+            if (!data.has_more) {
+                const loadOlder = document.getElementById('loadOlder');
+                if (loadOlder) {
+                    loadOlder.remove();
+                }
+            }
+        } catch (error) {
+            console.error('Failed to load older messages:', error);
+            this.showError('Failed to load older messages');
+        } finally {
+            this.isLoadingOlder = false;
+        }
+    }
+    
+    appendMessages(messages) {
         if (!this.messageContainer || !messages) {
             return;
         }
         
+        // Skip anything already on screen, confirming our own pending sends
+        const newMessages = messages.filter(message => {
+            const existing = message.message_id &&
+                this.messageContainer.querySelector(`[data-uuid="${message.message_id}"]`);
+            if (existing) {
+                this.reconcileMessage(existing, message);
+                return false;
+            }
+            return this.lastMessageId === null || message.id > this.lastMessageId;
+        });
+        if (newMessages.length === 0) {
+            return;
+        }
+        
         const currentScrollPos = this.messageContainer.scrollTop;
         const isScrolledToBottom = currentScrollPos >= 
             (this.messageContainer.scrollHeight - this.messageContainer.clientHeight - 50);
         
-        // Clear existing messages
-        this.messageContainer.innerHTML = '';
-        
-        if (messages.length === 0) {
-            this.showEmptyState();
-            return;
+        // Drop the empty-room placeholder once real messages arrive
+        const emptyState = document.getElementById('emptyState');
+        if (emptyState) {
+            emptyState.remove();
         }
         
         // Add messages
-        messages.forEach(message => {
+        newMessages.forEach(message => {
             this.addMessageElement(message);
         });
+        this.markRead(Math.max(...newMessages.map(message => message.id)));
         
         // Restore scroll position or scroll to bottom
         if (isScrolledToBottom) {
@@ -158,9 +418,15 @@ class ChatManager {
         }
     }
     
-    addMessageElement(message) {
+    addMessageElement(message, beforeElement = null) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${message.is_own ? 'message-own' : 'message-other'}`;
+        if (message.id !== null && message.id !== undefined) {
+            messageDiv.dataset.messageId = message.id;
+        }
+        if (message.message_id) {
+            messageDiv.dataset.uuid = message.message_id;
+        }
         
         let html = '';
         
@@ -178,12 +444,13 @@ class ChatManager {
         html += `<div class="message-time">${timeStr}</div>`;
         
         messageDiv.innerHTML = html;
-        this.messageContainer.appendChild(messageDiv);
+        this.messageContainer.insertBefore(messageDiv, beforeElement);
+        return messageDiv;
     }
     
     showEmptyState() {
         this.messageContainer.innerHTML = `
-            <div class="text-center text-muted py-5">
+            <div class="text-center text-muted py-5" id="emptyState">
                 <i data-feather="message-circle" style="width: 48px; height: 48px;" class="mb-3"></i>
                 <p>No messages yet. Start the conversation!</p>
             </div>
@@ -229,10 +496,39 @@ class ChatManager {
         }
     }
     
+    startStream() {
+        if (!this.currentRoom || typeof EventSource === 'undefined') {
+            return;
+        }
+        
+        // Always replay from the rendered page, even an empty one, so nothing
+        // posted between rendering and subscribing is missed
+        const url = `/stream/${this.currentRoom}?since=${this.lastMessageId !== null ? this.lastMessageId : 0}`;
+        
+        this.eventSource = new EventSource(url);
+        
+        this.eventSource.onopen = () => {
+            this.streamConnected = true;
+        };
+        
+        this.eventSource.onmessage = (e) => {
+            const message = JSON.parse(e.data);
+            this.appendMessages([message]);
+            if (this.lastMessageId === null || message.id > this.lastMessageId) {
+                this.lastMessageId = message.id;
+            }
+        };
+        
+        this.eventSource.onerror = () => {
+            // EventSource reconnects on its own; poll until it does
+            this.streamConnected = false;
+        };
+    }
+    
     startAutoRefresh() {
-        // Refresh every 15 seconds when page is visible
+        // Refresh every 15 seconds when page is visible and not streaming
         setInterval(() => {
-            if (!document.hidden && !this.isRefreshing) {
+            if (!document.hidden && !this.isRefreshing && !this.streamConnected) {
                 this.refreshMessages();
             }
         }, 15000);
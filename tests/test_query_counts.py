@@ -0,0 +1,85 @@
+"""SQL statement counts for the chat view and the message API
+
+Both views must issue a fixed number of statements no matter how many
+senders wrote the visible messages or how many rooms the viewer belongs to,
+so an N+1 regression shows up as a count that grows with the seed.
+"""
+import itertools
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'secret1'
+
+_user_numbers = itertools.count()
+
+
+@pytest.fixture(scope='module')
+def app(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp('query-counts')
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('DATABASE_URL', f"sqlite:///{workdir / 'chat.db'}")
+        patch.setenv('MASTER_KEY_FILE', str(workdir / 'master.key'))
+        patch.setenv('SCHEMA_AUTO_CREATE', 'true')
+        patch.setenv('RETENTION_INTERVAL', '0')
+        patch.setenv('PRESENCE_FLUSH_INTERVAL', '3600')
+        from app import create_app
+        yield create_app()
+
+
+def _login(app, username):
+    client = app.test_client()
+    client.post('/register', data={'username': username, 'email': f'{username}@example.com',
+                                   'password': PASSWORD, 'confirm_password': PASSWORD})
+    client.post('/login', data={'username': username, 'password': PASSWORD})
+    return client
+
+
+def _seed(app, viewer, senders):
+    """Add ``senders`` users who each post to room 1 and open a room the viewer joins"""
+    for n in itertools.islice(_user_numbers, senders):
+        client = _login(app, f'sender{n}')
+        client.post('/create_room', data={'room_name': f'room{n}'})
+        for i in range(3):
+            client.post('/api/messages/1', json={'content': f'message {i} from sender {n}'})
+        viewer.post('/join_room', data={'room_name': f'room{n}'})
+
+
+def _count_statements(app, client, url):
+    from app import db
+    from fragments import fragment_cache
+
+    statements = []
+
+    def count_statement(*args):
+        statements.append(args[2])
+
+    with app.app_context():
+        engine = db.engine
+    # Warm the membership cache and clear the unread marker first, but render
+    # the message list from scratch so the measured request loads every row
+    assert client.get(url).status_code == 200
+    fragment_cache.invalidate(1)
+    db.event.listen(engine, 'before_cursor_execute', count_statement)
+    try:
+        assert client.get(url).status_code == 200
+    finally:
+        db.event.remove(engine, 'before_cursor_execute', count_statement)
+    return len(statements)
+
+
+@pytest.mark.parametrize('url', ['/chat/1', '/api/messages/1', '/api/messages/1?since=0'])
+def test_statement_count_is_independent_of_senders_and_rooms(app, url):
+    viewer = _login(app, f'viewer{next(_user_numbers)}')
+
+    _seed(app, viewer, senders=2)
+    small = _count_statements(app, viewer, url)
+
+    _seed(app, viewer, senders=6)
+    large = _count_statements(app, viewer, url)
+
+    assert small == large